@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+# Session service that owns the single rfkill monitor and BlueZ mirror of a
+# desktop session. The blueberry window and tray follow its snapshot and
+# change signals instead of each monitoring rfkill and BlueZ themselves.
+
+import sys
+import rfkillMagic
+import bluezMagic
+import setproctitle
+from gi.repository import Gio, GLib
+
+setproctitle.setproctitle("blueberry-broker")
+
+BROKER_XML = """
+<node>
+  <interface name="org.linuxmint.blueberry.Broker">
+    <method name="GetRfkillDevices">
+      <arg type="a(uyyys)" name="devices" direction="out"/>
+    </method>
+    <method name="SetBlocked">
+      <arg type="b" name="blocked" direction="in"/>
+    </method>
+    <method name="GetBluezState">
+      <arg type="a{oa{sv}}" name="adapters" direction="out"/>
+      <arg type="a{oa{sv}}" name="devices" direction="out"/>
+    </method>
+    <signal name="RfkillEvent">
+      <arg type="u" name="idx"/>
+      <arg type="y" name="type"/>
+      <arg type="y" name="op"/>
+      <arg type="y" name="soft"/>
+      <arg type="y" name="hard"/>
+    </signal>
+    <signal name="RfkillError">
+      <arg type="s" name="message"/>
+    </signal>
+    <signal name="AdapterChanged">
+      <arg type="o" name="path"/>
+      <arg type="a{sv}" name="properties"/>
+    </signal>
+    <signal name="AdapterRemoved">
+      <arg type="o" name="path"/>
+    </signal>
+    <signal name="DeviceChanged">
+      <arg type="o" name="path"/>
+      <arg type="a{sv}" name="properties"/>
+    </signal>
+    <signal name="DeviceRemoved">
+      <arg type="o" name="path"/>
+    </signal>
+  </interface>
+</node>
+"""
+
+class Broker:
+    def __init__(self, debug):
+        self.enable_debugging = debug
+        self.loop = GLib.MainLoop()
+        self.connection = None
+        self.rfkill_err = None
+
+        self.rfkill = rfkillMagic.Interface(self.on_rfkill_updated, debug)
+        self.rfkill.add_adapter_callback(self.on_rfkill_adapter_changed)
+        self.rfkill.add_error_callback(self.on_rfkill_error)
+
+        self.bluez = bluezMagic.Mirror(debug=debug)
+        self.bluez.connect("adapter-changed", self.on_adapter_changed)
+        self.bluez.connect("adapter-removed", self.on_object_removed, "AdapterRemoved")
+        self.bluez.connect("device-changed", self.on_device_changed)
+        self.bluez.connect("device-removed", self.on_object_removed, "DeviceRemoved")
+
+        self.node_info = Gio.DBusNodeInfo.new_for_xml(BROKER_XML)
+        Gio.bus_own_name(Gio.BusType.SESSION, rfkillMagic.BROKER_BUS_NAME, Gio.BusNameOwnerFlags.NONE,
+                         self.on_bus_acquired, None, self.on_name_lost)
+
+    def run(self):
+        self.loop.run()
+        self.rfkill.terminate()
+
+    def on_bus_acquired(self, connection, name):
+        self.connection = connection
+        connection.register_object(rfkillMagic.BROKER_OBJECT_PATH, self.node_info.interfaces[0], self.on_method_call, None, None)
+
+    def on_name_lost(self, connection, name):
+        # Another broker is already running, or the session bus went away
+        self.debug("Lost %s, exiting" % name)
+        self.loop.quit()
+
+    def on_method_call(self, connection, sender, path, interface, method, params, invocation):
+        if method == "GetRfkillDevices":
+            devices = [(adapter.idx, adapter.type, adapter.soft, adapter.hard, adapter.name or "")
+                       for adapter in self.rfkill.adapters.values()]
+            invocation.return_value(GLib.Variant("(a(uyyys))", (devices,)))
+        elif method == "SetBlocked":
+            (blocked,) = params.unpack()
+            self.rfkill.try_set_blocked(blocked)
+            invocation.return_value(None)
+        elif method == "GetBluezState":
+            adapters = {path: bluezMagic.pack_properties(adapter, bluezMagic.ADAPTER_PROPERTIES)
+                        for (path, adapter) in self.bluez.adapters.items()}
+            devices = {path: bluezMagic.pack_properties(device, bluezMagic.DEVICE_PROPERTIES)
+                       for (path, device) in self.bluez.devices.items()}
+            invocation.return_value(GLib.Variant("(a{oa{sv}}a{oa{sv}})", (adapters, devices)))
+
+    def emit(self, signal, params):
+        if self.connection is not None:
+            self.connection.emit_signal(None, rfkillMagic.BROKER_OBJECT_PATH, rfkillMagic.BROKER_INTERFACE, signal, params)
+
+    def on_rfkill_adapter_changed(self, op, device):
+        self.emit("RfkillEvent", GLib.Variant("(uyyyy)", (device.idx, device.type, op, device.soft, device.hard)))
+
+    def on_rfkill_error(self, error):
+        # Sent for every failure: clients clear their error whenever they
+        # ask for a change, so a repeated one must be reported again
+        self.rfkill_err = error
+        self.emit("RfkillError", GLib.Variant("(s)", (error,)))
+
+    def on_rfkill_updated(self):
+        if self.rfkill_err is not None and self.rfkill.rfkill_err is None:
+            self.rfkill_err = None
+            self.emit("RfkillError", GLib.Variant("(s)", ("",)))
+
+    def on_adapter_changed(self, mirror, path):
+        properties = bluezMagic.pack_properties(mirror.adapters[path], bluezMagic.ADAPTER_PROPERTIES)
+        self.emit("AdapterChanged", GLib.Variant("(oa{sv})", (path, properties)))
+
+    def on_device_changed(self, mirror, path):
+        properties = bluezMagic.pack_properties(mirror.devices[path], bluezMagic.DEVICE_PROPERTIES)
+        self.emit("DeviceChanged", GLib.Variant("(oa{sv})", (path, properties)))
+
+    def on_object_removed(self, mirror, path, signal):
+        self.emit(signal, GLib.Variant("(o)", (path,)))
+
+    def debug(self, msg):
+        if self.enable_debugging:
+            print(msg)
+
+if __name__ == "__main__":
+    debug = len(sys.argv) > 1 and sys.argv[1] == "debug"
+    Broker(debug).run()
@@ -9,18 +9,23 @@
 import dbus
 import dbus.mainloop.glib
 import dbus.service
+import errno
 import fcntl
 import gettext
 import gi
 import os
 import setproctitle
 import shutil
+import signal
 import struct
 import subprocess
 import sys
 import termios
+import time
 import traceback
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from gi.types import GObjectMeta
 
@@ -31,6 +36,24 @@ from gi.repository import GObject, GLib, Gtk, Gio, Notify
 
 BOLD = lambda x: "\033[1m" + x + "\033[0m"
 
+AGENT_BUS_NAME = "org.linuxmint.blueberry.ObexAgent"
+AGENT_OBJECT_PATH = "/org/linuxmint/blueberry/ObexAgent"
+
+# Transfers we keep track of at most, in case obexd never tells us that
+# some of them are gone
+MAX_TRANSFERS = 64
+
+# Threads moving received files into SHARED_PATH
+MOVE_WORKERS = 2
+
+# How long we wait for obexd to acknowledge UnregisterAgent when exiting
+UNREGISTER_TIMEOUT = 2
+
+# How long we keep running after that for accepted transfers to finish and
+# received files to be moved, and how often we check (in ms)
+QUIT_TRANSFER_TIMEOUT = 60
+QUIT_POLL_INTERVAL = 500
+
 SHARED_PATH = GLib.get_user_special_dir(GLib.UserDirectory.DIRECTORY_DOWNLOAD)
 if SHARED_PATH is None or not os.path.exists(SHARED_PATH):
     SHARED_PATH = os.path.expanduser("~")
@@ -136,7 +159,9 @@ class Agent(_GDBusObject, dbus.service.Object, GObject.GObject):
 
 class SignalTracker:
     def __init__(self):
-        self._signals = []
+        # sigid -> [(objtype, obj, args, kwargs)], signals handled without
+        # a sigid are kept under None
+        self._signals = {}
 
     def Handle(self, *args, **kwargs):
         if "sigid" in kwargs:
@@ -161,46 +186,149 @@ class SignalTracker:
                 traceback.print_stack()
                 obj.bus.add_signal_receiver(*args, **kwargs)
 
-        self._signals.append((sigid, objtype, obj, args, kwargs))
+        self._signals.setdefault(sigid, []).append((objtype, obj, args, kwargs))
+
+    def _disconnect(self, objtype, obj, args, kwargs):
+        if objtype == "bluez":
+            obj.unhandle_signal(*args)
+        elif objtype == "gobject":
+            obj.disconnect(args)
+        elif objtype == "dbus":
+            if isinstance(obj, dbus.Bus):
+                if "path" in kwargs:
+                    obj.remove_signal_receiver(*args, **kwargs)
+                else:
+                    obj.remove_signal_receiver(*args)
+            else:
+                obj.bus.remove_signal_receiver(*args)
 
     def Disconnect(self, sigid):
-        for sig in self._signals:
-            (_sigid, objtype, obj, args, kwargs) = sig
-            if sigid != None and _sigid == sigid:
-                if objtype == "bluez":
-                    obj.unhandle_signal(*args)
-                elif objtype == "gobject":
-                    obj.disconnect(args)
-                elif objtype == "dbus":
-                    if isinstance(obj, dbus.Bus):
-                        if "path" in kwargs:
-                            obj.remove_signal_receiver(*args, **kwargs)
-                        else:
-                            obj.remove_signal_receiver(*args)
-                    else:
-                        obj.bus.remove_signal_receiver(*args)
-
-                self._signals.remove(sig)
+        if sigid is None:
+            return
 
+        for sig in self._signals.pop(sigid, []):
+            self._disconnect(*sig)
 
     def DisconnectAll(self):
-        for sig in self._signals:
-
-            (sigid, objtype, obj, args, kwargs) = sig
-            if objtype == "bluez":
-                obj.unhandle_signal(*args)
-            elif objtype == "gobject":
-                obj.disconnect(args)
-            elif objtype == "dbus":
-                if isinstance(obj, dbus.Bus):
-                    if "path" in kwargs:
-                        obj.remove_signal_receiver(*args, **kwargs)
-                    else:
-                        obj.remove_signal_receiver(*args)
-                else:
-                    obj.bus.remove_signal_receiver(*args)
+        for sigs in self._signals.values():
+            for sig in sigs:
+                self._disconnect(*sig)
+
+        self._signals = {}
+
+def copy_file(src, dest):
+    # Copies in the kernel, with copy_file_range() where the kernel and
+    # filesystems support it and sendfile() otherwise
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if count == 0:
+                        break
+                    copied += count
+            except OSError as e:
+                if copied > 0 or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+
+        while copied < size:
+            count = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+            if count == 0:
+                break
+            copied += count
+
+    shutil.copystat(src, dest)
+    return copied
+
+def move_file(src, dest):
+    # Returns the number of bytes that had to be copied, 0 for a rename
+    try:
+        os.rename(src, dest)
+        return 0
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    try:
+        copied = copy_file(src, dest)
+        size = os.stat(src).st_size
+        if copied != size:
+            raise OSError(errno.EIO, "Copied %d of %d bytes" % (copied, size), dest)
+    except OSError:
+        if os.path.exists(dest):
+            os.unlink(dest)
+        raise
+
+    os.unlink(src)
+    return copied
+
+# Address -> name of the devices BlueZ knows about, loaded with a single
+# GetManagedObjects call and then kept up to date from its signals, so that
+# authorizing a push doesn't have to ask anybody.
+class DeviceNameCache:
+    def __init__(self):
+        self._names = {}
+        self._addresses = {}
+        self._signals = SignalTracker()
+
+        try:
+            self._bus = dbus.SystemBus()
+            manager = dbus.Interface(self._bus.get_object('org.bluez', '/'), 'org.freedesktop.DBus.ObjectManager')
+        except dbus.DBusException as e:
+            dprint("BlueZ is not available, device names won't be shown:", e)
+            return
 
-        self._signals = []
+        self._signals.Handle('dbus', self._bus, self._on_interfaces_added, 'InterfacesAdded',
+                             'org.freedesktop.DBus.ObjectManager', 'org.bluez')
+        self._signals.Handle('dbus', self._bus, self._on_interfaces_removed, 'InterfacesRemoved',
+                             'org.freedesktop.DBus.ObjectManager', 'org.bluez')
+        self._signals.Handle('dbus', self._bus, self._on_properties_changed, 'PropertiesChanged',
+                             'org.freedesktop.DBus.Properties', 'org.bluez',
+                             arg0='org.bluez.Device1', path_keyword='path')
+
+        manager.GetManagedObjects(reply_handler=self._on_managed_objects,
+                                  error_handler=lambda error: dprint(error))
+
+    def close(self):
+        self._signals.DisconnectAll()
+
+    def get_name(self, address):
+        return self._names.get(str(address).upper(), _("Unknown device"))
+
+    def _update(self, path, properties):
+        if 'Address' in properties:
+            self._addresses[path] = str(properties['Address']).upper()
+
+        address = self._addresses.get(path)
+        if address is None:
+            return
+
+        name = properties.get('Alias', properties.get('Name'))
+        if name is not None:
+            self._names[address] = str(name)
+        elif address not in self._names:
+            self._names[address] = address
+
+    def _on_managed_objects(self, objects):
+        for path, interfaces in objects.items():
+            if 'org.bluez.Device1' in interfaces:
+                self._update(path, interfaces['org.bluez.Device1'])
+        dprint("%d device names" % len(self._names))
+
+    def _on_interfaces_added(self, object_path, interfaces):
+        if 'org.bluez.Device1' in interfaces:
+            self._update(object_path, interfaces['org.bluez.Device1'])
+
+    def _on_interfaces_removed(self, object_path, interfaces):
+        if 'org.bluez.Device1' in interfaces:
+            address = self._addresses.pop(object_path, None)
+            self._names.pop(address, None)
+
+    def _on_properties_changed(self, interface_name, changed_properties, _invalidated_properties, path=None):
+        self._update(path, changed_properties)
 
 class NotificationBubble(Notify.Notification):
 
@@ -236,8 +364,10 @@ class NotificationBubble(Notify.Notification):
         return self
 
 class _Agent:
-    def __init__(self):
+    def __init__(self, device_names):
         self._agent_path = '/org/blueberry/obex_agent'
+        self._registered = False
+        self._device_names = device_names
 
         self._agent = Agent(self._agent_path)
         self._agent.connect('release', self._on_release)
@@ -247,12 +377,29 @@ class _Agent:
         self._allowed_devices = []
         self._notification = None
         self._pending_transfer = None
+        # The transfer obexd is waiting for an answer about, None once it
+        # was answered or cancelled
+        self._authorizing = None
         self.transfers = {}
 
         AgentManager().register_agent(self._agent_path)
+        self._registered = True
 
     def __del__(self):
-        AgentManager().unregister_agent(self._agent_path)
+        if self._registered:
+            AgentManager().unregister_agent(self._agent_path)
+
+    def unregister(self, callback=None):
+        if self._registered:
+            self._registered = False
+            # Free the object path for the agent of a later load()
+            self._agent.remove_from_connection()
+            AgentManager().unregister_agent(self._agent_path, callback)
+        elif callback:
+            callback()
+
+    def is_registered(self):
+        return self._registered
 
     def _on_release(self, _agent):
         raise Exception(self._agent_path + " was released unexpectedly")
@@ -260,6 +407,11 @@ class _Agent:
     def _on_action(self, _notification, action):
         dprint(action)
 
+        if self._authorizing != self._pending_transfer['transfer_path']:
+            # Already answered, or cancelled by obexd
+            return
+        self._authorizing = None
+
         if action == "accept":
             self.transfers[self._pending_transfer['transfer_path']] = {
                 'path': self._pending_transfer['root'] + '/' + os.path.basename(self._pending_transfer['filename']),
@@ -273,22 +425,61 @@ class _Agent:
             self._agent.reply_rejected(None)
 
     def _on_authorize(self, _agent, transfer_path, address=None, filename=None, size=None):
+        self._authorizing = transfer_path
+
         if address and filename and size:
             # stand-alone obexd
             # FIXME: /tmp is only the default. Can we get the actual root
             # directory from stand-alone obexd?
             root = '/tmp'
-            name = _("Unknown device")
-        else:
-            # BlueZ 5 integrated obexd
-            transfer = Transfer(transfer_path)
-            session = Session(transfer.session)
-            root = session.root
-            address = session.address
-            filename = transfer.name
-            size = transfer.size
-            name = get_device_name_by_address(session.address)
+            name = self._device_names.get_name(address)
+            self._request_authorization(transfer_path, address, root, filename, size, name)
+            return
 
+        # BlueZ 5 integrated obexd: usually both snapshots are already known
+        # from InterfacesAdded, otherwise each costs one GetAll
+        round_trips = [0]
+
+        def is_current():
+            # obexd may have cancelled, or moved on to another transfer,
+            # while we were waiting for GetAll
+            if self._authorizing == transfer_path:
+                return True
+            dprint(transfer_path, "no longer being authorized, dropping reply")
+            return False
+
+        def on_error(error):
+            dprint(transfer_path, error)
+            if is_current():
+                self._authorizing = None
+                self._agent.reply_rejected(None)
+
+        def on_transfer_properties(transfer, count):
+            round_trips[0] += count
+            if not is_current():
+                return
+
+            if 'Session' not in transfer:
+                on_error("%s has no session" % transfer_path)
+                return
+
+            def on_session_properties(session, count):
+                round_trips[0] += count
+                if not is_current():
+                    return
+                dprint(transfer_path, "authorizing after %d round trips" % round_trips[0])
+                # Name and Size are optional, pushes without a Length header
+                # have no Size
+                address = session.get('Destination', "")
+                self._request_authorization(transfer_path, address, session.get('Root', '/tmp'),
+                                            transfer.get('Name') or os.path.basename(transfer_path),
+                                            transfer.get('Size', 0), self._device_names.get_name(address))
+
+            Session.get_properties(transfer['Session'], on_session_properties, on_error)
+
+        Transfer.get_properties(transfer_path, on_transfer_properties, on_error)
+
+    def _request_authorization(self, transfer_path, address, root, filename, size, name):
         self._pending_transfer = {'transfer_path': transfer_path, 'address': address, 'root': root,
                                   'filename': filename, 'size': size, 'name': name}
 
@@ -314,7 +505,9 @@ class _Agent:
             self._on_action(self._notification, "accept")
 
     def _on_cancel(self, agent):
-        self._notification.close()
+        self._authorizing = None
+        if self._notification:
+            self._notification.close()
         agent.reply_cancelled(None)
 
 
@@ -325,20 +518,53 @@ class TransferService():
     _manager = None
     _agent = None
     _watch = None
+    _device_names = None
+
+    # Received files are moved off the main loop, so a copy across
+    # filesystems doesn't keep us from answering obexd
+    _mover = ThreadPoolExecutor(max_workers=MOVE_WORKERS)
+    _pending_moves = set()
+    _bytes_moved = 0
+    _move_time = 0.0
 
     def load(self):
-        self._manager = Manager()
-        self._manager.connect("transfer-started", self._on_transfer_started)
-        self._manager.connect("transfer-completed", self._on_transfer_completed)
-        self._manager.connect('session-removed', self._on_session_removed)
+        self._device_names = DeviceNameCache()
+
+        # Kept across unload() and load(), it still follows the transfers
+        # accepted before an unload
+        if self._manager is None:
+            self._manager = Manager()
+            self._manager.connect("transfer-started", self._on_transfer_started)
+            self._manager.connect("transfer-completed", self._on_transfer_completed)
+            self._manager.connect("transfer-released", self._on_transfer_released)
+            self._manager.connect('session-removed', self._on_session_removed)
 
         self._watch = dbus.SessionBus().watch_name_owner("org.bluez.obex", self._on_obex_owner_changed)
 
-    def unload(self):
+    def unload(self, callback=None):
         if self._watch:
             self._watch.cancel()
+            self._watch = None
+
+        # The agent is only unregistered, its accepted transfers are still
+        # completed and moved
+        if self._agent:
+            self._agent.unregister(callback)
+        elif callback:
+            callback()
 
-        self._agent = None
+        if self._device_names:
+            self._device_names.close()
+            self._device_names = None
+
+    def is_loaded(self):
+        return self._watch is not None
+
+    def is_registered(self):
+        return self._agent is not None and self._agent.is_registered()
+
+    def has_pending_work(self):
+        return len(self._pending_moves) > 0 or (self._agent is not None and len(self._agent.transfers) > 0)
 
     def on_manager_state_changed(self, state):
         if not state:
@@ -349,10 +575,13 @@ class TransferService():
         if owner == "":
             self._agent = None
         else:
-            self._agent = _Agent()
+            agent = _Agent(self._device_names)
+            if self._agent is not None:
+                agent.transfers.update(self._agent.transfers)
+            self._agent = agent
 
     def _on_transfer_started(self, _manager, transfer_path):
-        if transfer_path not in self._agent.transfers:
+        if self._agent is None or transfer_path not in self._agent.transfers:
             # This is not an incoming transfer we authorized
             return
 
@@ -376,7 +605,7 @@ class TransferService():
     def _on_transfer_completed(self, _manager, transfer_path, success):
         try:
             attributes = self._agent.transfers[transfer_path]
-        except KeyError:
+        except (AttributeError, KeyError):
             # This is probably not an incoming transfer we authorized
             return
 
@@ -388,15 +617,44 @@ class TransferService():
         if hasattr(dest_dir, "upper",) and hasattr(dest_dir, "decode"):
             dest_dir = dest_dir.decode("UTF-8")
 
-        if os.path.exists(os.path.join(dest_dir, filename)):
+        if os.path.exists(os.path.join(dest_dir, filename)) or os.path.join(dest_dir, filename) in self._pending_moves:
             now = datetime.now()
             filename = "%s_%s" % (now.strftime("%Y%m%d%H%M%S"), filename)
             dprint("Destination file exists, renaming to: %s" % filename)
 
         dest = os.path.join(dest_dir, filename)
-        shutil.move(src, dest)
+        self._pending_moves.add(dest)
+
+        if not success:
+            if attributes['size'] > 350000:
+                self._normal_transfers -= 1
+            else:
+                self._silent_transfers -= 1
+
+        del self._agent.transfers[transfer_path]
+
+        def move():
+            start = time.monotonic()
+            copied = move_file(src, dest)
+            return (copied, time.monotonic() - start)
+
+        future = self._mover.submit(move)
+        future.add_done_callback(lambda future: GLib.idle_add(self._on_file_moved, future, dest, filename,
+                                                              attributes['name'], success))
+
+    def _on_file_moved(self, future, dest, filename, attr, success):
+        self._pending_moves.discard(dest)
+
+        try:
+            (copied, elapsed) = future.result()
+            self._bytes_moved += copied
+            self._move_time += elapsed
+            dprint("Moved %s in %.3f s, %d bytes copied (%d bytes in %.3f s in total)" %
+                   (dest, elapsed, copied, self._bytes_moved, self._move_time))
+        except OSError as e:
+            dprint("Could not move %s: %s" % (dest, e))
+            success = False
 
-        attr = attributes['name']
         try:
             filename = str("<b>%s</b>" % filename)
             attr = str("<b>%s</b>" % attr)
@@ -409,18 +667,18 @@ class TransferService():
                                  "0": filename,
                                  "1": attr})
             self._add_open(n, _("Open"), dest)
-        elif not success:
+        else:
             NotificationBubble(_("Transfer failed"),
                          _("Transfer of file %(0)s failed") % {
                              "0": filename,
                              "1": attr})
 
-            if attributes['size'] > 350000:
-                self._normal_transfers -= 1
-            else:
-                self._silent_transfers -= 1
+        return GLib.SOURCE_REMOVE
 
-        del self._agent.transfers[transfer_path]
+    def _on_transfer_released(self, _manager, transfer_path):
+        # Gone without a final status, e.g. removed by obexd or evicted
+        if self._agent is not None:
+            self._agent.transfers.pop(transfer_path, None)
 
     def _on_session_removed(self, _manager, _session_path):
         if self._silent_transfers == 0:
@@ -474,6 +732,45 @@ class Base(GObject.GObject):
     def __del__(self):
         self.__signals.DisconnectAll()
 
+    def close(self):
+        self.__signals.DisconnectAll()
+
+    # Snapshots of the properties that never change during the lifetime of a
+    # Session or Transfer, keyed by object path. They are filled from
+    # InterfacesAdded when possible, otherwise with a single async GetAll.
+    _snapshot_interface = None
+    _snapshot_properties = ()
+
+    @classmethod
+    def store_properties(cls, obj_path, properties):
+        snapshot = cls._snapshots.setdefault(obj_path, {})
+        for name in cls._snapshot_properties:
+            if name in properties:
+                snapshot[name] = properties[name]
+
+    @classmethod
+    def forget_properties(cls, obj_path):
+        cls._snapshots.pop(obj_path, None)
+
+    @classmethod
+    def get_properties(cls, obj_path, reply_handler, error_handler):
+        # reply_handler(snapshot, round_trips) is called with the number of
+        # D-Bus calls it took, 0 when the snapshot was already known. Both
+        # InterfacesAdded and GetAll carry every property the object has, so
+        # a stored snapshot is complete even when optional ones (like
+        # Transfer1.Size) are missing from it.
+        snapshot = cls._snapshots.get(obj_path)
+        if snapshot is not None:
+            reply_handler(snapshot, 0)
+            return
+
+        def on_properties(properties):
+            cls.store_properties(obj_path, properties)
+            reply_handler(cls._snapshots[obj_path], 1)
+
+        dbus.SessionBus().call_async('org.bluez.obex', obj_path, 'org.freedesktop.DBus.Properties', 'GetAll',
+                                     's', (cls._snapshot_interface,), on_properties, error_handler)
+
     def _handle_signal(self, handler, signal):
         self.__signals.Handle('dbus', self.__bus, handler, signal, self.__interface_name, self.__bus_name,
                               self.__obj_path)
@@ -487,6 +784,10 @@ class Base(GObject.GObject):
         return self.__obj_path
 
 class Session(Base):
+    _snapshots = {}
+    _snapshot_interface = 'org.bluez.obex.Session1'
+    _snapshot_properties = ('Root', 'Destination')
+
     def __init__(self, session_path):
         if self.__class__.get_interface_version()[0] < 5:
             super(Session, self).__init__('org.bluez.obex.Session', session_path)
@@ -521,6 +822,29 @@ class Transfer(Base):
         str('error'): (GObject.SignalFlags.NO_HOOKS, None, (GObject.TYPE_PYOBJECT,))
     }
 
+    _snapshots = {}
+    _snapshot_interface = 'org.bluez.obex.Transfer1'
+    _snapshot_properties = ('Name', 'Size', 'Session')
+
+    # All Transfer1 PropertiesChanged signals arrive through one match rule
+    # and are dispatched by object path, instead of one rule per transfer.
+    _instances = {}
+    _receiver_added = False
+
+    @classmethod
+    def _add_receiver(cls):
+        if not cls._receiver_added:
+            dbus.SessionBus().add_signal_receiver(cls._dispatch_properties_changed, 'PropertiesChanged',
+                                                  'org.freedesktop.DBus.Properties', 'org.bluez.obex',
+                                                  arg0='org.bluez.obex.Transfer1', path_keyword='path')
+            cls._receiver_added = True
+
+    @classmethod
+    def _dispatch_properties_changed(cls, interface_name, changed_properties, invalidated_properties, path=None):
+        transfer = cls._instances.get(path)
+        if transfer is not None:
+            transfer._on_properties_changed(interface_name, changed_properties, invalidated_properties)
+
     def __init__(self, transfer_path):
         if self.__class__.get_interface_version()[0] < 5:
             super(Transfer, self).__init__('org.bluez.obex.Transfer', transfer_path, True)
@@ -535,14 +859,23 @@ class Transfer(Base):
                 self._handle_signal(handler, signal)
         else:
             super(Transfer, self).__init__('org.freedesktop.DBus.Properties', transfer_path)
-            self._handle_signal(self._on_properties_changed, 'PropertiesChanged')
+            Transfer._add_receiver()
+            Transfer._instances[transfer_path] = self
+
+    def close(self):
+        super(Transfer, self).close()
+        if Transfer._instances.get(self.object_path) is self:
+            del Transfer._instances[self.object_path]
 
     def __getattr__(self, name):
         if name in ('filename', 'name', 'session', 'size'):
             if self.__class__.get_interface_version()[0] < 5:
                 raise NotImplementedError()
-            else:
-                return self._interface.Get('org.bluez.obex.Transfer1', name.capitalize())
+
+            snapshot = self._snapshots.get(self.object_path, {})
+            if name.capitalize() in snapshot:
+                return snapshot[name.capitalize()]
+            return self._interface.Get('org.bluez.obex.Transfer1', name.capitalize())
 
     def _on_property_changed(self, name, value):
         if name == 'Progress':
@@ -576,6 +909,7 @@ class Manager(Base):
         str('session-removed'): (GObject.SignalFlags.NO_HOOKS, None, (GObject.TYPE_PYOBJECT,)),
         str('transfer-started'): (GObject.SignalFlags.NO_HOOKS, None, (GObject.TYPE_PYOBJECT,)),
         str('transfer-completed'): (GObject.SignalFlags.NO_HOOKS, None, (GObject.TYPE_PYOBJECT, GObject.TYPE_PYOBJECT)),
+        str('transfer-released'): (GObject.SignalFlags.NO_HOOKS, None, (GObject.TYPE_PYOBJECT,)),
     }
 
     def __init__(self):
@@ -593,29 +927,60 @@ class Manager(Base):
         else:
             super(Manager, self).__init__('org.freedesktop.DBus.ObjectManager', '/')
 
-            self._transfers = {}
+            self._transfers = OrderedDict()
 
             def on_interfaces_added(object_path, interfaces):
+                if 'org.bluez.obex.Session1' in interfaces:
+                    Session.store_properties(object_path, interfaces['org.bluez.obex.Session1'])
+
                 if 'org.bluez.obex.Transfer1' in interfaces:
+                    Transfer.store_properties(object_path, interfaces['org.bluez.obex.Transfer1'])
+
                     def on_tranfer_completed(_transfer):
                         self._on_transfer_completed(object_path, True)
+                        self._release_transfer(object_path)
 
                     def on_tranfer_error(_transfer, _msg):
                         self._on_transfer_completed(object_path, False)
+                        self._release_transfer(object_path)
+
+                    def on_transfer_progress(_transfer, _value):
+                        # Transfers that make progress are the last to be evicted
+                        if object_path in self._transfers:
+                            self._transfers.move_to_end(object_path)
+
+                    transfer = Transfer(object_path)
+                    transfer.connect('completed', on_tranfer_completed)
+                    transfer.connect('error', on_tranfer_error)
+                    transfer.connect('progress', on_transfer_progress)
+                    self._transfers[object_path] = transfer
+
+                    while len(self._transfers) > MAX_TRANSFERS:
+                        self._release_transfer(next(iter(self._transfers)))
 
-                    self._transfers[object_path] = Transfer(object_path)
-                    self._transfers[object_path].connect('completed', on_tranfer_completed)
-                    self._transfers[object_path].connect('error', on_tranfer_error)
                     self._on_transfer_started(object_path)
 
             self._handle_signal(on_interfaces_added, 'InterfacesAdded')
 
             def on_interfaces_removed(object_path, interfaces):
+                if 'org.bluez.obex.Transfer1' in interfaces:
+                    self._release_transfer(object_path)
+
                 if 'org.bluez.obex.Session1' in interfaces:
+                    Session.forget_properties(object_path)
                     self._on_session_removed(object_path)
 
             self._handle_signal(on_interfaces_removed, 'InterfacesRemoved')
 
+    def _release_transfer(self, transfer_path):
+        # Drops the proxy and its match rules once a transfer is over
+        Transfer.forget_properties(transfer_path)
+        transfer = self._transfers.pop(transfer_path, None)
+        if transfer is not None:
+            dprint(transfer_path, "%d transfers left" % len(self._transfers))
+            transfer.close()
+            self.emit('transfer-released', transfer_path)
+
     def _on_session_removed(self, session_path):
         dprint(session_path)
         self.emit('session-removed', session_path)
@@ -707,42 +1072,115 @@ class AgentManager(Base):
 
         self._interface.RegisterAgent(agent_path, reply_handler=on_registered, error_handler=on_register_failed)
 
-    def unregister_agent(self, agent_path):
+    def unregister_agent(self, agent_path, callback=None):
         def on_unregistered():
             dprint(agent_path)
+            if callback:
+                callback()
 
         def on_unregister_failed(error):
             dprint(agent_path, error)
+            if callback:
+                callback()
 
         self._interface.UnregisterAgent(agent_path, reply_handler=on_unregistered, error_handler=on_unregister_failed)
 
 
-def get_device_name_by_address(address):
-    text = subprocess.check_output(["bt-device", "--info=" + address]).decode("utf-8").strip()
-
-    for line in text.splitlines():
-        line = line.strip()
-        if line.startswith("Name:"):
-            return line[5:].strip()
-
-    raise ValueError
-
+# Lets the blueberry window enable, disable and query the agent over D-Bus
+class AgentControl(dbus.service.Object):
+    def __init__(self, service, mainloop):
+        dbus.service.Object.__init__(self, dbus.SessionBus(), AGENT_OBJECT_PATH)
+        self._service = service
+        self._mainloop = mainloop
+        self._quitting = False
+        self._quit_time = None
+        self._unregister_timeout_id = 0
+        self._drain_timeout_id = 0
+
+    @dbus.service.method(AGENT_BUS_NAME)
+    def Enable(self):
+        dprint()
+        if self._quitting:
+            # Turned back on before we were gone
+            self._quitting = False
+            for source_id in (self._unregister_timeout_id, self._drain_timeout_id):
+                if source_id:
+                    GLib.source_remove(source_id)
+            self._unregister_timeout_id = 0
+            self._drain_timeout_id = 0
+
+        if not self._service.is_loaded():
+            self._service.load()
+
+    @dbus.service.method(AGENT_BUS_NAME)
+    def Disable(self):
+        dprint()
+        self.quit()
+
+    @dbus.service.method(AGENT_BUS_NAME, out_signature='b')
+    def Status(self):
+        return self._service.is_registered()
+
+    def quit(self, *args):
+        # Unregister from obexd before exiting, so it doesn't keep
+        # sending requests to an agent that is gone, then let accepted
+        # transfers finish
+        if not self._quitting:
+            self._quitting = True
+            self._quit_time = time.monotonic()
+            self._service.unload(self._on_unregistered)
+            self._unregister_timeout_id = GLib.timeout_add_seconds(UNREGISTER_TIMEOUT, self._on_unregister_timeout)
+        return GLib.SOURCE_REMOVE
+
+    def _on_unregister_timeout(self):
+        self._unregister_timeout_id = 0
+        self._on_unregistered()
+        return GLib.SOURCE_REMOVE
+
+    def _on_unregistered(self):
+        if self._unregister_timeout_id:
+            GLib.source_remove(self._unregister_timeout_id)
+            self._unregister_timeout_id = 0
+
+        if self._quitting and not self._drain_timeout_id:
+            self._drain_timeout_id = GLib.timeout_add(QUIT_POLL_INTERVAL, self._on_drain_timeout)
+
+    def _on_drain_timeout(self):
+        if self._service.has_pending_work() and time.monotonic() - self._quit_time < QUIT_TRANSFER_TIMEOUT:
+            return GLib.SOURCE_CONTINUE
+
+        if self._service.has_pending_work():
+            dprint("Giving up on unfinished transfers")
+        self._drain_timeout_id = 0
+        self._mainloop.quit()
+        return GLib.SOURCE_REMOVE
 
 if __name__ == '__main__':
     settings = Gio.Settings(schema="org.blueberry")
     if settings.get_boolean("obex-enabled"):
         try:
             dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+            try:
+                bus_name = dbus.service.BusName(AGENT_BUS_NAME, dbus.SessionBus(), do_not_queue=True)
+            except dbus.exceptions.NameExistsException:
+                dprint("blueberry-obex-agent is already running, exiting.")
+                sys.exit(0)
+
             mainloop = GLib.MainLoop()
             service = TransferService()
             service.load()
-            cont = True
-            while cont:
-                try:
-                    mainloop.run()
-                except KeyboardInterrupt:
-                    service.unload()
-                    cont = False
+
+            control = AgentControl(service, mainloop)
+
+            def on_obex_enabled_changed(settings, key):
+                if not settings.get_boolean(key):
+                    control.quit()
+
+            settings.connect("changed::obex-enabled", on_obex_enabled_changed)
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, control.quit)
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, control.quit)
+
+            mainloop.run()
         except Exception as e:
             dprint("Something went wrong in blueberry-obex-agent: %s" % e)
             dprint("Setting org.blueberry obex-enabled to False and exiting.")
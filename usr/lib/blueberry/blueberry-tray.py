@@ -1,13 +1,15 @@
 #!/usr/bin/python3
 
 import sys
+import time
 import gettext
 import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('GnomeBluetooth', '1.0')
 gi.require_version('XApp', '1.0')
-from gi.repository import Gtk, Gdk, GnomeBluetooth, Gio, XApp
+from gi.repository import Gtk, Gdk, Gio, GLib, XApp
 import rfkillMagic
+import bluezMagic
 import setproctitle
 import subprocess
 
@@ -16,6 +18,214 @@ gettext.install("blueberry", "/usr/share/locale")
 
 setproctitle.setproctitle("blueberry-tray")
 
+class DeviceRecord:
+    __slots__ = ("path", "name", "connected", "paired")
+
+    def __init__(self, path):
+        self.path = path
+        self.name = None
+        self.connected = False
+        self.paired = False
+
+# The devices of the default adapter, keyed by object path, with the paths
+# of the connected and paired ones kept in their own sets.
+class DeviceIndex:
+    def __init__(self):
+        self.devices = {}
+        self.connected = set()
+        self.paired = set()
+
+    def update(self, path, name, connected, paired):
+        record = self.devices.get(path)
+        if record is None:
+            record = self.devices[path] = DeviceRecord(path)
+        elif (record.name, record.connected, record.paired) == (name, connected, paired):
+            return False
+
+        record.name = name
+        record.connected = connected
+        record.paired = paired
+
+        if connected:
+            self.connected.add(path)
+        else:
+            self.connected.discard(path)
+
+        if paired:
+            self.paired.add(path)
+        else:
+            self.paired.discard(path)
+
+        return True
+
+    def remove(self, path):
+        if self.devices.pop(path, None) is None:
+            return False
+        self.connected.discard(path)
+        self.paired.discard(path)
+        return True
+
+    def clear(self):
+        self.devices.clear()
+        self.connected.clear()
+        self.paired.clear()
+
+    def get_connected_names(self):
+        return sorted(self.devices[path].name for path in self.connected)
+
+# Feeds a DeviceIndex from the GnomeBluetooth model. Each signal only reads
+# the row it is about; we keep the object path of every child row of the
+# default adapter so that deleted rows can be matched to their device.
+class ModelBackend:
+    def __init__(self, index, changed_callback):
+        # Only loaded when this backend is used, see BluezBackend
+        from gi.repository import GnomeBluetooth
+        self.columns = GnomeBluetooth.Column
+
+        self.index = index
+        self.changed_callback = changed_callback
+        self.client = GnomeBluetooth.Client()
+        self.model = self.client.get_model()
+        self.default_row = None
+        self.rows = []
+
+        self.handlers = [self.model.connect('row-changed', self.on_row_changed),
+                         self.model.connect('row-deleted', self.on_row_deleted),
+                         self.model.connect('row-inserted', self.on_row_inserted)]
+        self.rebuild()
+
+    def connect_device(self, path, connect):
+        self.client.connect_service(path, connect)
+
+    def stop(self):
+        for handler in self.handlers:
+            self.model.disconnect(handler)
+        self.model = None
+        self.client = None
+
+    def rebuild(self):
+        self.index.clear()
+        self.default_row = None
+        self.rows = []
+
+        iter = self.model.get_iter_first()
+        while iter:
+            if self.model.get_value(iter, self.columns.DEFAULT):
+                self.default_row = self.model.get_path(iter).get_indices()[0]
+                break
+            iter = self.model.iter_next(iter)
+
+        if iter is not None:
+            child = self.model.iter_children(iter)
+            while child:
+                self.rows.append(None)
+                self.update_row(len(self.rows) - 1, child)
+                child = self.model.iter_next(child)
+
+        self.changed_callback()
+
+    def update_row(self, position, iter):
+        proxy = self.model.get_value(iter, self.columns.PROXY)
+        if proxy is None:
+            return False
+
+        path = proxy.get_object_path()
+        changed = False
+        if self.rows[position] != path:
+            if self.rows[position] is not None:
+                changed = self.index.remove(self.rows[position])
+            self.rows[position] = path
+
+        return self.index.update(path,
+                                 self.model.get_value(iter, self.columns.NAME) or "",
+                                 self.model.get_value(iter, self.columns.CONNECTED),
+                                 self.model.get_value(iter, self.columns.PAIRED)) or changed
+
+    def is_default_child(self, indices):
+        return len(indices) == 2 and indices[0] == self.default_row
+
+    def on_row_changed(self, model, path, iter):
+        indices = path.get_indices()
+        if len(indices) == 1:
+            # Adapter row: only matters when the default adapter changes
+            is_default = self.model.get_value(iter, self.columns.DEFAULT)
+            if is_default != (indices[0] == self.default_row):
+                self.rebuild()
+        elif self.is_default_child(indices) and indices[1] < len(self.rows):
+            if self.update_row(indices[1], iter):
+                self.changed_callback()
+
+    def on_row_inserted(self, model, path, iter):
+        indices = path.get_indices()
+        if len(indices) == 1:
+            self.rebuild()
+        elif self.is_default_child(indices):
+            self.rows.insert(indices[1], None)
+            if self.update_row(indices[1], iter):
+                self.changed_callback()
+
+    def on_row_deleted(self, model, path):
+        indices = path.get_indices()
+        if len(indices) == 1:
+            self.rebuild()
+        elif self.is_default_child(indices) and indices[1] < len(self.rows):
+            device_path = self.rows.pop(indices[1])
+            if device_path is not None and self.index.remove(device_path):
+                self.changed_callback()
+
+# Feeds a DeviceIndex straight from the BlueZ objects, through the broker's
+# mirror, without GnomeBluetooth and its full device model.
+class BluezBackend:
+    def __init__(self, index, changed_callback, debug):
+        self.index = index
+        self.changed_callback = changed_callback
+        self.adapter_path = None
+
+        self.mirror = bluezMagic.Mirror(use_broker=True, debug=debug)
+        self.handlers = [self.mirror.connect("ready", self.on_ready),
+                         self.mirror.connect("adapter-changed", self.on_adapter_changed),
+                         self.mirror.connect("adapter-removed", self.on_adapter_changed),
+                         self.mirror.connect("device-changed", self.on_device_changed),
+                         self.mirror.connect("device-removed", self.on_device_removed)]
+        self.rebuild()
+
+    def connect_device(self, path, connect):
+        self.mirror.connect_device(path, connect)
+
+    def stop(self):
+        for handler in self.handlers:
+            self.mirror.disconnect(handler)
+        self.mirror.stop()
+        self.mirror = None
+
+    def rebuild(self):
+        self.index.clear()
+        self.adapter_path = self.mirror.get_default_adapter()
+        for (path, device) in self.mirror.get_devices(self.adapter_path).items():
+            self.update_device(path, device)
+        self.changed_callback()
+
+    def update_device(self, path, device):
+        return self.index.update(path, device.get("Alias", ""), device.get("Connected", False), device.get("Paired", False))
+
+    def on_ready(self, mirror):
+        self.rebuild()
+
+    def on_adapter_changed(self, mirror, path):
+        if mirror.get_default_adapter() != self.adapter_path:
+            self.rebuild()
+
+    def on_device_changed(self, mirror, path):
+        device = mirror.devices[path]
+        if device.get("Adapter") != self.adapter_path:
+            return
+        if self.update_device(path, device):
+            self.changed_callback()
+
+    def on_device_removed(self, mirror, path):
+        if self.index.remove(path):
+            self.changed_callback()
+
 class BluetoothTray(Gtk.Application):
     def __init__(self):
         super(BluetoothTray, self).__init__(register_session=True, application_id="org.linuxmint.blueberry.tray")
@@ -29,8 +239,9 @@ class BluetoothTray(Gtk.Application):
         debug = False
         if len(sys.argv) > 1 and sys.argv[1] == "debug":
             debug = True
+        self.enable_debugging = debug
 
-        self.rfkill = rfkillMagic.Interface(self.update_icon_callback, debug)
+        self.rfkill = rfkillMagic.Interface(self.update_icon_callback, debug, backend=rfkillMagic.BrokerBackend())
         self.settings = Gio.Settings(schema="org.blueberry")
         self.settings.connect("changed::tray-enabled", self.on_settings_changed_cb)
 
@@ -42,144 +253,211 @@ class BluetoothTray(Gtk.Application):
             self.tray_active_icon = "blueberry-tray-active-symbolic"
             self.tray_disabled_icon = "blueberry-tray-disabled-symbolic"
 
-        # If we have no adapter, or disabled tray, end early
-        if (not self.rfkill.have_adapter) or (not self.settings.get_boolean("tray-enabled")):
+        # If the tray is disabled, end early
+        if not self.settings.get_boolean("tray-enabled"):
             self.rfkill.terminate()
             sys.exit(0)
 
-        self.client = GnomeBluetooth.Client()
-        self.model = self.client.get_model()
-        self.model.connect('row-changed', self.update_icon_callback)
-        self.model.connect('row-deleted', self.update_icon_callback)
-        self.model.connect('row-inserted', self.update_icon_callback)
+        # Without an adapter we stay dormant, only following rfkill through
+        # the broker, until one is plugged in.
+        self.icon = None
+        self.backend = None
+        self.rfkill.add_adapter_callback(self.on_rfkill_adapter_changed)
+        if self.rfkill.have_adapter:
+            self.wake_up()
+        else:
+            self.debug("No Bluetooth adapter, waiting for one")
+
+    def on_rfkill_adapter_changed(self, op, device):
+        if self.icon is None and self.rfkill.have_adapter:
+            self.wake_up()
+
+    def wake_up(self):
+        start = time.monotonic()
 
         self.icon = XApp.StatusIcon()
         self.icon.set_name("blueberry")
-        self.icon.set_tooltip_text(_("Bluetooth"))
+        self.published_icon = None
+        self.published_tooltip = None
+        self.icon_updates_published = 0
+        self.icon_updates_suppressed = 0
+        self.build_menu()
         self.icon.connect("activate", self.on_statusicon_activated)
         self.icon.connect("button-release-event", self.on_statusicon_released)
 
-        self.update_icon_callback(None, None, None)
+        self.devices = DeviceIndex()
+        if self.settings.get_boolean("tray-lean-mode"):
+            self.backend = BluezBackend(self.devices, self.update_icon_callback, self.enable_debugging)
+        else:
+            self.backend = ModelBackend(self.devices, self.update_icon_callback)
+
+        self.debug("Tray icon up in %.1f ms" % ((time.monotonic() - start) * 1000))
+
+    def go_dormant(self):
+        self.debug("Bluetooth adapter gone, waiting for one")
+        self.backend.stop()
+        self.backend = None
+        self.menu.destroy()
+        self.menu = None
+        self.icon.set_visible(False)
+        self.icon = None
 
     def on_settings_changed_cb(self, setting, key, data=None):
         if not self.settings.get_boolean("tray-enabled"):
             self.terminate()
 
-    def update_icon_callback(self, path=None, iter=None, data=None):
+    def update_icon_callback(self):
+        if self.icon is None:
+            return
+
         if not self.rfkill.have_adapter:
-            self.terminate(None)
+            self.go_dormant()
             return
 
         if self.rfkill.hard_block or self.rfkill.soft_block:
-            self.icon.set_icon_name(self.tray_disabled_icon)
-            self.icon.set_tooltip_text(_("Bluetooth is disabled"))
+            self.publish_icon_state(self.tray_disabled_icon, _("Bluetooth is disabled"))
         else:
-            self.icon.set_icon_name(self.tray_icon)
             self.update_connected_state()
 
-    def update_connected_state(self):
-        self.get_devices()
+        self.update_menu()
 
-        if len(self.connected_devices) > 0:
-            self.icon.set_icon_name(self.tray_active_icon)
-            self.icon.set_tooltip_text(_("Bluetooth: Connected to %s") % (", ".join(self.connected_devices)))
+    def update_connected_state(self):
+        if len(self.devices.connected) > 0:
+            self.publish_icon_state(self.tray_active_icon,
+                                    _("Bluetooth: Connected to %s") % (", ".join(self.devices.get_connected_names())))
         else:
-            self.icon.set_icon_name(self.tray_icon)
-            self.icon.set_tooltip_text(_("Bluetooth"))
-
-    def get_devices(self):
-        self.connected_devices = []
-        self.paired_devices = {}
-        default_iter = None
+            self.publish_icon_state(self.tray_icon, _("Bluetooth"))
 
-        iter = self.model.get_iter_first()
-
-        while iter:
-            default = self.model.get_value(iter, GnomeBluetooth.Column.DEFAULT)
-            if default:
-                default_iter = iter
-                break
-            iter = self.model.iter_next(iter)
-
-        if default_iter != None:
-            iter = self.model.iter_children(default_iter)
-            while iter:
-                connected = self.model.get_value(iter, GnomeBluetooth.Column.CONNECTED)
-                if connected:
-                    name = self.model.get_value(iter, GnomeBluetooth.Column.NAME)
-                    self.connected_devices.append(name)
+    def publish_icon_state(self, icon_name, tooltip):
+        # Every setter is a round trip to the applet, so only send what differs
+        # from what we published last.
+        if icon_name == self.published_icon and tooltip == self.published_tooltip:
+            self.icon_updates_suppressed += 1
+            return
 
-                paired = self.model.get_value(iter, GnomeBluetooth.Column.PAIRED)
-                if paired:
-                    name = self.model.get_value(iter, GnomeBluetooth.Column.NAME)
-                    proxy = self.model.get_value(iter, GnomeBluetooth.Column.PROXY)
-                    self.paired_devices[name] = proxy
+        if icon_name != self.published_icon:
+            self.icon.set_icon_name(icon_name)
+            self.published_icon = icon_name
+        if tooltip != self.published_tooltip:
+            self.icon.set_tooltip_text(tooltip)
+            self.published_tooltip = tooltip
 
-                iter = self.model.iter_next(iter)
+        self.icon_updates_published += 1
+        self.debug("Tray icon: %s, '%s' (%d published, %d suppressed)" %
+                          (icon_name, tooltip, self.icon_updates_published, self.icon_updates_suppressed))
 
     def on_statusicon_activated(self, icon, button, time):
         if button == Gdk.BUTTON_PRIMARY:
-            subprocess.Popen(["blueberry"])
+            self.launch_manager()
+
+    def launch_manager(self):
+        # Raise a running blueberry directly, and only start a new one
+        # when nobody answers
+        def on_activated(connection, result):
+            try:
+                connection.call_finish(result)
+            except GLib.Error:
+                subprocess.Popen(["blueberry"])
+
+        Gio.bus_get_sync(Gio.BusType.SESSION, None).call("com.linuxmint.blueberry",
+                                                         "/com/linuxmint/blueberry",
+                                                         "org.freedesktop.Application",
+                                                         "Activate",
+                                                         GLib.Variant("(a{sv})", ({},)),
+                                                         None,
+                                                         Gio.DBusCallFlags.NO_AUTO_START,
+                                                         -1,
+                                                         None,
+                                                         on_activated)
+
+    def build_menu(self):
+        # Built once; update_menu() keeps it in sync with the rfkill and
+        # device state so that right-click only has to pop it up.
+        self.menu = Gtk.Menu()
+
+        self.turn_on_item = Gtk.MenuItem(label=_("Turn on Bluetooth"))
+        self.turn_on_item.connect("activate", self.turn_on_bluetooth)
+        self.menu.append(self.turn_on_item)
+
+        self.turn_off_item = Gtk.MenuItem(label=_("Turn off Bluetooth"))
+        self.turn_off_item.connect("activate", self.turn_off_bluetooth)
+        self.menu.append(self.turn_off_item)
+
+        self.send_files_item = Gtk.MenuItem(label=_("Send files to a device"))
+        self.send_files_item.connect("activate", self.send_files_cb)
+        self.menu.append(self.send_files_item)
+
+        item = Gtk.MenuItem(label=_("Open Bluetooth device manager"))
+        item.connect("activate", self.open_manager_cb)
+        self.menu.append(item)
+
+        self.paired_separator = Gtk.SeparatorMenuItem()
+        self.menu.append(self.paired_separator)
+        self.paired_item = Gtk.MenuItem(label=_("Paired devices"))
+        self.menu.append(self.paired_item)
+        self.paired_menu = Gtk.Menu()
+        self.paired_item.set_submenu(self.paired_menu)
+        self.paired_items = {}
+
+        self.menu.append(Gtk.SeparatorMenuItem())
+
+        item = Gtk.MenuItem(label=_("Quit"))
+        item.connect("activate", self.terminate)
+        self.menu.append(item)
+
+        self.menu.show_all()
+
+    def update_menu(self):
+        blocked = self.rfkill.hard_block or self.rfkill.soft_block
+        self.turn_on_item.set_visible(self.rfkill.soft_block and not self.rfkill.hard_block)
+        self.turn_off_item.set_visible(not blocked)
+        self.send_files_item.set_visible(not blocked)
+
+        for path in list(self.paired_items):
+            if path not in self.devices.paired:
+                self.paired_items.pop(path).destroy()
+
+        paired = sorted(self.devices.paired, key=lambda path: self.devices.devices[path].name)
+        for (position, path) in enumerate(paired):
+            item = self.paired_items.get(path)
+            if item is None:
+                item = self.paired_items[path] = Gtk.ImageMenuItem()
+                item.set_always_show_image(True)
+                item.connect("activate", self.toggle_connect_cb, path)
+                self.paired_menu.insert(item, position)
+                item.show()
+            elif self.paired_menu.get_children()[position] is not item:
+                self.paired_menu.reorder_child(item, position)
+
+            name = self.devices.devices[path].name
+            if item.get_label() != name:
+                item.set_label(name)
+
+            connected = path in self.devices.connected
+            if connected != (item.get_image() is not None):
+                if connected:
+                    image = Gtk.Image.new_from_icon_name("emblem-ok-symbolic", Gtk.IconSize.MENU)
+                    image.set_tooltip_text(_("Connected"))
+                    item.set_image(image)
+                else:
+                    item.set_image(None)
+
+        self.paired_separator.set_visible(len(paired) > 0)
+        self.paired_item.set_visible(len(paired) > 0)
 
     def on_statusicon_released(self, icon, x, y, button, time, position):
         if button == 3:
-            menu = Gtk.Menu()
-
-            if not self.rfkill.hard_block:
-                if self.rfkill.soft_block:
-                    item = Gtk.MenuItem(label=_("Turn on Bluetooth"))
-                    item.connect("activate", self.turn_on_bluetooth)
-                    menu.append(item)
-                else:
-                    item = Gtk.MenuItem(label=_("Turn off Bluetooth"))
-                    item.connect("activate", self.turn_off_bluetooth)
-                    menu.append(item)
-
-            if not(self.rfkill.hard_block or self.rfkill.soft_block):
-                item = Gtk.MenuItem(label=_("Send files to a device"))
-                item.connect("activate", self.send_files_cb)
-                menu.append(item)
-
-            item = Gtk.MenuItem(label=_("Open Bluetooth device manager"))
-            item.connect("activate", self.open_manager_cb)
-            menu.append(item)
-
-            if len(self.paired_devices) > 0:
-                menu.append(Gtk.SeparatorMenuItem())
-                m_item = Gtk.MenuItem(label=_("Paired devices"))
-                menu.append(m_item)
-                paired_menu = Gtk.Menu()
-                m_item.set_submenu(paired_menu)
-                for device in self.paired_devices:
-                    label = device
-                    item = Gtk.ImageMenuItem(label=label)
-                    if device in self.connected_devices:
-                        image = Gtk.Image.new_from_icon_name("emblem-ok-symbolic", Gtk.IconSize.MENU)
-                        image.set_tooltip_text(_("Connected"))
-                        item.set_always_show_image(True)
-                        item.set_image(image)
-                    item.connect("activate",self.toggle_connect_cb, device)
-                    paired_menu.append(item)
-
-            menu.append(Gtk.SeparatorMenuItem())
-
-            item = Gtk.MenuItem(label=_("Quit"))
-            item.connect("activate", self.terminate)
-            menu.append(item)
-
-            menu.show_all()
-            icon.popup_menu(menu, x, y, button, time, position)
+            icon.popup_menu(self.menu, x, y, button, time, position)
 
     def toggle_connect_cb(self, item, data = None):
-        proxy = self.paired_devices[data]
-        connected = data in self.connected_devices
-        self.client.connect_service(proxy.get_object_path(), not connected)
+        connected = data in self.devices.connected
+        self.backend.connect_device(data, not connected)
 
     def send_files_cb(self, item, data = None):
         subprocess.Popen(["bluetooth-sendto"])
 
     def open_manager_cb(self, item, data = None):
-        subprocess.Popen(["blueberry"])
+        self.launch_manager()
 
     def turn_on_bluetooth(self, item):
         self.rfkill.try_set_blocked(False)
@@ -192,5 +470,9 @@ class BluetoothTray(Gtk.Application):
     def terminate(self, window = None, data = None):
         self.quit()
 
+    def debug(self, msg):
+        if self.enable_debugging:
+            print(msg)
+
 if __name__ == "__main__":
     BluetoothTray().run()
@@ -1,8 +1,12 @@
 #!/usr/bin/python3
 
+import time
+IMPORTS_START = time.monotonic()
+
 import sys, os
 import gettext
 import rfkillMagic
+import bluezMagic
 import setproctitle
 import subprocess
 from BlueberrySettingsWidgets import SettingsBox, SettingsRow
@@ -10,10 +14,18 @@ import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('GnomeBluetooth', '1.0')
 from gi.repository import Gtk, GnomeBluetooth, Gio, GLib
+IMPORTS_END = time.monotonic()
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 APPLICATION_ID = 'com.linuxmint.blueberry'
 
+# Renames typed in quick succession are written to BlueZ only once
+RENAME_DELAY = 300
+
+# Model signals arriving within this many milliseconds of each other cause a
+# single status refresh
+STATUS_REFRESH_DELAY = 250
+
 # i18n
 gettext.install("blueberry", "/usr/share/locale")
 
@@ -43,58 +55,207 @@ def find_widget(parent, name="", widgetClass=None):
 
     return None
 
+TRAY_BUS_NAME = 'org.linuxmint.blueberry.tray'
+
+OBEX_AGENT_BUS_NAME = 'org.linuxmint.blueberry.ObexAgent'
+OBEX_AGENT_OBJECT_PATH = '/org/linuxmint/blueberry/ObexAgent'
+OBEX_AGENT_PATH = '/usr/lib/blueberry/blueberry-obex-agent.py'
+DBUS_START_REPLY_ALREADY_RUNNING = 2
+
+# A tray we just spawned gets this many seconds to claim its bus name before
+# we would consider spawning another one
+TRAY_SPAWN_TIMEOUT = 10
+
+# Minimum time between two spawns, so a tray that keeps dying isn't
+# restarted in a loop
+TRAY_RESPAWN_DELAY = 2
+
+# Starts blueberry-tray only when it isn't already running or starting,
+# based on the ownership of its bus name.
+class TrayManager:
+    def __init__(self, settings):
+        self.settings = settings
+        self.owned = None
+        self.wanted = False
+        self.spawn_time = None
+        self.last_spawn_time = None
+        self.toggle_time = None
+        self.respawn_id = 0
+        self.spawns = 0
+        self.spawns_avoided = 0
+        self.watch_id = Gio.bus_watch_name(Gio.BusType.SESSION, TRAY_BUS_NAME, Gio.BusNameWatcherFlags.NONE,
+                                           self.on_name_appeared, self.on_name_vanished)
+
+    def ensure_running(self, toggled=False):
+        # toggled is True when tray-enabled was just turned back on
+        if self.owned is None:
+            # We don't know yet, decide once the watch reports back
+            self.wanted = True
+            return
+
+        starting = self.spawn_time is not None and time.monotonic() - self.spawn_time < TRAY_SPAWN_TIMEOUT
+        if self.owned or starting:
+            if toggled and self.owned:
+                # The running tray may still be about to quit because of the
+                # 'off' that came before, replace it if it does
+                self.toggle_time = time.monotonic()
+            self.spawns_avoided += 1
+            return
+
+        self.spawn_time = time.monotonic()
+        self.last_spawn_time = self.spawn_time
+        self.spawns += 1
+        subprocess.Popen(['blueberry-tray'])
+
+    def on_name_appeared(self, connection, name, owner):
+        self.owned = True
+        self.spawn_time = None
+        if self.wanted:
+            self.wanted = False
+            self.spawns_avoided += 1
+
+    def on_name_vanished(self, connection, name):
+        self.owned = False
+        if self.wanted:
+            self.wanted = False
+            self.ensure_running()
+        elif self.toggle_time is not None and time.monotonic() - self.toggle_time < TRAY_SPAWN_TIMEOUT:
+            # Only a tray that quit right after an off/on toggle is replaced,
+            # not one the user quit from its menu
+            self.toggle_time = None
+            self.respawn()
+
+    def respawn(self):
+        delay = 0
+        if self.last_spawn_time is not None:
+            delay = self.last_spawn_time + TRAY_RESPAWN_DELAY - time.monotonic()
+
+        if delay > 0:
+            if not self.respawn_id:
+                self.respawn_id = GLib.timeout_add(int(delay * 1000), self.on_respawn_timeout)
+        elif self.settings.get_boolean("tray-enabled"):
+            self.ensure_running()
+
+    def on_respawn_timeout(self):
+        self.respawn_id = 0
+        if self.settings.get_boolean("tray-enabled"):
+            self.ensure_running()
+        return GLib.SOURCE_REMOVE
+
+# Collapses bursts of requests into one call of callback per delay (in ms)
+class Debouncer:
+    def __init__(self, callback, delay):
+        self.callback = callback
+        self.delay = delay
+        self.source_id = 0
+        self.applied = 0
+        self.suppressed = 0
+
+    def queue(self):
+        if self.source_id:
+            self.suppressed += 1
+            return
+        self.source_id = GLib.timeout_add(self.delay, self.on_timeout)
+
+    def skip(self):
+        self.suppressed += 1
+
+    def on_timeout(self):
+        self.source_id = 0
+        self.applied += 1
+        self.callback()
+        return GLib.SOURCE_REMOVE
+
 class Blueberry(Gtk.Application):
     def do_startup(self):
+        startup_start = time.monotonic()
+        self.startup_timings = [("imports", IMPORTS_END - IMPORTS_START)]
+
         Gtk.Application.do_startup(self)
 
         self.settings = Gio.Settings(schema="org.blueberry")
+        self.tray = TrayManager(self.settings)
+
+        # The desktop is only detected once a panel needs a configuration tool
+        self.de = None
+        self.configuration_tools = None
+
+        self.startup_timings.append(("do_startup", time.monotonic() - startup_start))
+
+    def detect_desktop(self):
+        xdg_current_desktop = os.environ.get("XDG_CURRENT_DESKTOP", "")
+
+        if xdg_current_desktop == "MATE":
+            return "Mate"
+        elif xdg_current_desktop == "XFCE":
+            return "Xfce"
+        elif xdg_current_desktop == "X-Cinnamon":
+            return "Cinnamon"
+        elif "GNOME" in xdg_current_desktop:
+            return "Gnome"
+        elif xdg_current_desktop == "Unity":
+            return "Unity"
+        elif xdg_current_desktop == "LXDE":
+            return "LXDE"
 
-        #detect current DE
+        # Only ask the window manager when XDG_CURRENT_DESKTOP doesn't tell
         wm_info = subprocess.getoutput("wmctrl -m")
-        if "XDG_CURRENT_DESKTOP" in os.environ:
-            xdg_current_desktop = os.environ["XDG_CURRENT_DESKTOP"]
-        else:
-            xdg_current_desktop = ""
 
-        if "Marco" in wm_info or xdg_current_desktop == "MATE":
-            self.de = "Mate"
+        if "Marco" in wm_info:
+            return "Mate"
+        elif "Xfwm4" in wm_info:
+            return "Xfce"
+        elif "Muffin" in wm_info:
+            return "Cinnamon"
+        elif "Mutter" in wm_info:
+            return "Gnome"
+        elif "Unity" in wm_info:
+            return "Unity"
+
+        return "Unknown"
+
+    def get_configuration_tools(self):
+        if self.configuration_tools is not None:
+            return self.configuration_tools
+
+        self.de = self.detect_desktop()
+
+        if self.de == "Mate":
             self.configuration_tools = {"sound": "mate-volume-control", "keyboard": "mate-keyboard-properties", "mouse": "mate-mouse-properties"}
-        elif "Xfwm4" in wm_info or xdg_current_desktop == "XFCE":
-            self.de = "Xfce"
+        elif self.de == "Xfce":
             self.configuration_tools = {"keyboard": "xfce4-keyboard-settings", "mouse": "xfce4-mouse-settings"}
             if os.path.exists("/usr/bin/pavucontrol"):
                 self.configuration_tools["sound"] = "pavucontrol"
             else:
                 self.configuration_tools["sound"] = "xfce4-mixer"
-        elif "Muffin" in wm_info or xdg_current_desktop == "X-Cinnamon":
-            self.de = "Cinnamon"
+        elif self.de == "Cinnamon":
             self.configuration_tools = {"sound": "cinnamon-settings sound", "keyboard": "cinnamon-settings keyboard", "mouse": "cinnamon-settings mouse"}
-        elif "Mutter" in wm_info or "GNOME" in xdg_current_desktop:
-            self.de = "Gnome"
+        elif self.de == "Gnome":
             self.configuration_tools = {"sound": "gnome-control-center sound", "keyboard": "gnome-control-center keyboard", "mouse": "gnome-control-center mouse"}
-        elif "Unity" in wm_info or xdg_current_desktop == "Unity":
-            self.de = "Unity"
+        elif self.de == "Unity":
             self.configuration_tools = {"sound": "unity-control-center sound", "keyboard": "unity-control-center keyboard", "mouse": "unity-control-center mouse"}
-        elif xdg_current_desktop == "LXDE":
-            self.de = "LXDE"
+        elif self.de == "LXDE":
             self.configuration_tools = {"sound": "pavucontrol", "keyboard": "lxinput", "mouse": "lxinput"}
         else:
-            self.de = "Unknown"
             log("DE could not be detected!")
             self.configuration_tools = {}
             if os.path.exists("/usr/bin/pavucontrol"):
                 self.configuration_tools["sound"] = "pavucontrol"
 
+        return self.configuration_tools
+
     def do_activate(self):
         if self.settings.get_boolean("tray-enabled"):
-            subprocess.Popen(['blueberry-tray'])
+            self.tray.ensure_running()
 
         if len(self.get_windows()) > 0:
             # Blueberry is already running, focus the window
             self.get_active_window().present()
             return
 
+        builder_start = time.monotonic()
         builder = Gtk.Builder.new_from_file(os.path.join(SCRIPT_DIR, "blueberry.ui"))
+        self.startup_timings.append(("Gtk.Builder", time.monotonic() - builder_start))
 
         window = builder.get_object("window")
         window.set_title(_("Bluetooth"))
@@ -106,6 +267,7 @@ class Blueberry(Gtk.Application):
         debug = False
         if len(sys.argv) > 1 and sys.argv[1] == "debug":
             debug = True
+        self.enable_debugging = debug
 
         self.header_icon = builder.get_object("header-icon")
         self.status_icon = builder.get_object("status-icon")
@@ -113,7 +275,7 @@ class Blueberry(Gtk.Application):
 
         # Devices
         self.rf_switch = builder.get_object("bluetooth-switch")
-        self.rfkill = rfkillMagic.Interface(self.update_ui_callback, debug)
+        self.rfkill = rfkillMagic.Interface(self.update_ui_callback, debug, backend=rfkillMagic.BrokerBackend())
         self.rf_handler_id = self.rf_switch.connect("state-set", self.on_switch_changed)
 
         self.rfkill_error_image = builder.get_object("rfkill-error-image")
@@ -123,6 +285,9 @@ class Blueberry(Gtk.Application):
         settings_container = builder.get_object("settings-container")
         settings_container.pack_start(settings_box, True, True, 0)
 
+        self.pending_alias = None
+        self.rename_timeout_id = 0
+
         self.adapter_name_entry = Gtk.Entry(width_chars=30)
         self.adapter_name_entry.connect("focus-out-event", self.update_name_from_entry)
         self.adapter_name_entry.connect("activate", self.update_name_from_entry)
@@ -135,7 +300,6 @@ class Blueberry(Gtk.Application):
         self.obex_switch = Gtk.Switch()
         self.obex_switch.set_active(self.settings.get_boolean("obex-enabled"))
         self.obex_switch.connect("notify::active", self.on_obex_switch_toggled)
-        self.settings.connect("changed", self.on_settings_changed)
         row = SettingsRow(Gtk.Label(label=_("Receive files from remote devices")), self.obex_switch)
         row.set_tooltip_text(_("This option allows your computer to receive files transferred over Bluetooth (OBEX)"))
         settings_box.add_row(row)
@@ -148,24 +312,55 @@ class Blueberry(Gtk.Application):
 
         settings_box.show_all()
 
-        self.lib_widget = GnomeBluetooth.SettingsWidget.new()
-        self.lib_widget.connect("panel-changed", self.panel_changed)
-        builder.get_object("bluetooth-widget-box").pack_start(self.lib_widget, True, True, 0)
+        # The device panel and its GnomeBluetooth client are only built once
+        # the main page is shown, see ensure_device_panel()
+        self.widget_box = builder.get_object("bluetooth-widget-box")
+        self.lib_widget = None
+        self.label_widget = None
+        self.client = None
+        self.bluez = None
 
         self.add_window(window)
+        self.first_frame_handler_id = window.connect("draw", self.on_first_frame)
         window.show_all()
         self.update_ui_callback()
 
+    def ensure_device_panel(self):
+        if self.lib_widget is not None:
+            return
+
+        panel_start = time.monotonic()
+
+        self.lib_widget = GnomeBluetooth.SettingsWidget.new()
+        self.lib_widget.connect("panel-changed", self.panel_changed)
+        self.widget_box.pack_start(self.lib_widget, True, True, 0)
+        self.lib_widget.show_all()
+
         # attempt to apply overrides and if we fail don't setup update hooks
         if self.get_label_widget_and_spinner(self.lib_widget):
             self.label_widget.set_text("")
             self.client = GnomeBluetooth.Client()
             self.model = self.client.get_model()
-            self.model.connect('row-changed', self.on_adapter_status_changed)
-            self.model.connect('row-deleted', self.on_adapter_status_changed)
-            self.model.connect('row-inserted', self.on_adapter_status_changed)
+            self.status_debouncer = Debouncer(self.on_status_refresh, STATUS_REFRESH_DELAY)
+            self.model.connect('row-changed', self.on_model_row_changed)
+            self.model.connect('row-deleted', self.on_model_row_deleted)
+            self.model.connect('row-inserted', self.on_model_row_changed)
+
+            # Adapter aliases come from BlueZ and are cached, instead of
+            # asking bt-adapter every time the model changes
+            try:
+                self.bluez = bluezMagic.Mirror(use_broker=True, debug=self.enable_debugging)
+                self.bluez.connect("ready", self.on_adapter_status_changed)
+                self.bluez.connect("adapter-changed", self.on_adapter_status_changed)
+                self.bluez.connect("adapter-removed", self.on_adapter_status_changed)
+            except GLib.Error as e:
+                log("Could not monitor BlueZ, using bt-adapter: {}".format(e.message))
+                self.bluez = None
+
             self.on_adapter_status_changed(self.lib_widget)
 
+        self.debug("device panel built in %.1f ms" % ((time.monotonic() - panel_start) * 1000))
+
     def bluetooth_on(self):
         return not self.rfkill.soft_block and not self.rfkill.hard_block
 
@@ -201,52 +396,162 @@ class Blueberry(Gtk.Application):
         return True
 
     def on_adapter_status_changed(self, settings, foo=None, data=None):
-        if self.bluetooth_on():
-            self.adapter_name_entry.set_text(self.get_adapter_name())
-        else:
-            self.adapter_name_entry.set_text("")
+        if self.pending_alias is not None and self.bluez is not None:
+            if self.bluez.get_adapter_alias() == self.pending_alias:
+                # BlueZ confirmed the rename
+                self.pending_alias = None
+
+        # Don't overwrite what the user is typing
+        if not self.adapter_name_entry.has_focus():
+            if self.bluetooth_on():
+                self.adapter_name_entry.set_text(self.get_adapter_name())
+            else:
+                self.adapter_name_entry.set_text("")
         self.update_status(self.adapter_name_entry)
 
+    # Only adapter rows (the top level of the model) matter to the status, the
+    # device rows below them change with every RSSI update during discovery.
+    def on_model_row_changed(self, model, path, iter):
+        self.queue_status_refresh(path)
+
+    def on_model_row_deleted(self, model, path):
+        self.queue_status_refresh(path)
+
+    def queue_status_refresh(self, path):
+        if path.get_depth() > 1:
+            self.status_debouncer.skip()
+        else:
+            self.status_debouncer.queue()
+
+    def on_status_refresh(self):
+        self.debug("status refresh: %d applied, %d suppressed" % (self.status_debouncer.applied, self.status_debouncer.suppressed))
+        self.on_adapter_status_changed(self.model)
+
+    def on_first_frame(self, window, cr):
+        window.disconnect(self.first_frame_handler_id)
+        self.startup_timings.append(("first frame (since imports)", time.monotonic() - IMPORTS_START))
+
+        if self.enable_debugging:
+            print("Startup timings:")
+            for (name, duration) in self.startup_timings:
+                print("  %-28s %7.1f ms" % (name, duration * 1000))
+
+        return False
+
     def panel_changed(self, widget, panel=None):
-        if not panel in self.configuration_tools:
+        configuration_tools = self.get_configuration_tools()
+        if not panel in configuration_tools:
             log("No configuration tool known for panel '{}'".format(panel))
         else:
-            os.system("%s &" % self.configuration_tools[panel])
+            os.system("%s &" % configuration_tools[panel])
 
     def on_tray_switch_toggled(self, widget, data=None):
+        if widget.get_active() != self.settings.get_boolean("tray-enabled"):
+            self.settings.set_boolean("tray-enabled", widget.get_active())
         if widget.get_active():
-            self.settings.set_boolean("tray-enabled", True)
-            subprocess.Popen(["blueberry-tray"])
-        else:
-            self.settings.set_boolean("tray-enabled", False)
+            self.tray.ensure_running(toggled=True)
 
     def on_obex_switch_toggled(self, widget, data=None):
-        if widget.get_active():
-            self.settings.set_boolean("obex-enabled", True)
-            os.system("/usr/lib/blueberry/blueberry-obex-agent.py &")
+        # The agent itself is started or stopped from on_settings_changed()
+        if widget.get_active() != self.settings.get_boolean("obex-enabled"):
+            self.settings.set_boolean("obex-enabled", widget.get_active())
+
+    def set_obex_agent_running(self, running):
+        bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+
+        if running:
+            # Make sure the agent reads the new value when it starts
+            Gio.Settings.sync()
+
+            def on_started(connection, result):
+                try:
+                    (reply,) = connection.call_finish(result).unpack()
+                except GLib.Error as e:
+                    log("Could not activate the OBEX agent, starting it directly: {}".format(e.message))
+                    subprocess.Popen([OBEX_AGENT_PATH])
+                    return
+
+                if reply == DBUS_START_REPLY_ALREADY_RUNNING:
+                    # It may be on its way out after a quick off/on toggle,
+                    # Enable keeps it running
+                    connection.call(OBEX_AGENT_BUS_NAME, OBEX_AGENT_OBJECT_PATH, OBEX_AGENT_BUS_NAME, "Enable",
+                                    None, None, Gio.DBusCallFlags.NO_AUTO_START, -1, None, None)
+
+            bus.call("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus", "StartServiceByName",
+                     GLib.Variant("(su)", (OBEX_AGENT_BUS_NAME, 0)), None, Gio.DBusCallFlags.NONE, -1, None, on_started)
         else:
-            self.settings.set_boolean("obex-enabled", False)
-            os.system("pkill -9 blueberry-obex");
-        self.update_status()
+            # The agent unregisters from obexd before it exits
+            bus.call(OBEX_AGENT_BUS_NAME, OBEX_AGENT_OBJECT_PATH, OBEX_AGENT_BUS_NAME, "Disable",
+                     None, None, Gio.DBusCallFlags.NO_AUTO_START, -1, None, None)
 
     def update_name_from_entry(self, entry, arg1=None, data=None):
         name = entry.get_text()
         if name == "":
-            adapter_name = self.client.props.default_adapter_name
+            adapter_name = self.client.props.default_adapter_name if self.client else None
             name = adapter_name if adapter_name else ""
             entry.set_text(name)
 
-        subprocess.call(["bt-adapter", "--set", "Alias", name])
+        if name == self.get_adapter_name():
+            return
+
+        # Show the new name right away, and write it once the user has
+        # stopped editing
+        self.pending_alias = name
+        if self.rename_timeout_id:
+            GLib.source_remove(self.rename_timeout_id)
+        self.rename_timeout_id = GLib.timeout_add(RENAME_DELAY, self.write_adapter_name)
         self.update_status()
 
+    def write_adapter_name(self):
+        self.rename_timeout_id = 0
+        name = self.pending_alias
+
+        adapter_path = self.bluez.get_default_adapter() if self.bluez is not None else None
+        if adapter_path is not None:
+            self.bluez.set_adapter_alias(adapter_path, name, self.on_adapter_name_written)
+        else:
+            subprocess.call(["bt-adapter", "--set", "Alias", name])
+            self.pending_alias = None
+            self.update_status()
+
+        return GLib.SOURCE_REMOVE
+
+    def on_adapter_name_written(self, error):
+        if error is not None:
+            log("Could not rename the Bluetooth adapter: {}".format(error))
+            self.pending_alias = None
+            self.on_adapter_status_changed(None)
+
     def on_settings_changed(self, settings, key):
-        self.tray_switch.set_active(self.settings.get_boolean("tray-enabled"))
-        self.obex_switch.set_active(self.settings.get_boolean("obex-enabled"))
+        if key == "tray-enabled":
+            enabled = self.settings.get_boolean(key)
+            if self.tray_switch.get_active() != enabled:
+                self.tray_switch.set_active(enabled)
+        elif key == "obex-enabled":
+            enabled = self.settings.get_boolean(key)
+            if self.obex_switch.get_active() != enabled:
+                self.obex_switch.set_active(enabled)
+            self.set_obex_agent_running(enabled)
+            self.update_status()
 
     def get_adapter_name(self):
         if not self.bluetooth_on():
             return ""
 
+        if self.pending_alias is not None:
+            name = self.pending_alias
+        elif self.bluez is not None:
+            name = self.bluez.get_adapter_alias()
+        else:
+            name = self.get_adapter_name_from_bt_adapter()
+
+        if name == None:
+            default_name = self.client.props.default_adapter_name if self.client else None
+            name = default_name if (default_name != None) else ""
+
+        return name
+
+    def get_adapter_name_from_bt_adapter(self):
         name = None
 
         try:
@@ -259,10 +564,6 @@ class Blueberry(Gtk.Application):
         except Exception as cause:
             log("Could not retrieve the BT adapter name with 'bt-adapter -i': {}".format(cause))
 
-        if name == None:
-            default_name = self.client.props.default_adapter_name
-            name = default_name if (default_name != None) else ""
-
         return name
 
     def update_status(self, path=None, iter=None, data=None):
@@ -333,12 +634,19 @@ class Blueberry(Gtk.Application):
         self.rf_switch.set_state(powered)
         self.rf_switch.handler_unblock(self.rf_handler_id)
 
+        if powered:
+            self.ensure_device_panel()
+
         self.stack.set_visible_child_name("main-page" if powered else "status-page");
 
     def on_switch_changed(self, widget, state):
         self.rfkill.try_set_blocked(not state)
         return True
 
+    def debug(self, msg):
+        if self.enable_debugging:
+            print(msg)
+
 if __name__ == "__main__":
     app = Blueberry(application_id=APPLICATION_ID, flags=Gio.ApplicationFlags.FLAGS_NONE)
     app.run(None)
@@ -0,0 +1,262 @@
+from gi.repository import GLib, Gio, GObject
+from rfkillMagic import BROKER_BUS_NAME, BROKER_OBJECT_PATH, BROKER_INTERFACE, BROKER_TIMEOUT
+
+BLUEZ_BUS_NAME = "org.bluez"
+ADAPTER_INTERFACE = "org.bluez.Adapter1"
+DEVICE_INTERFACE = "org.bluez.Device1"
+OBJECT_MANAGER_INTERFACE = "org.freedesktop.DBus.ObjectManager"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+
+# The only properties we mirror, with their D-Bus types. Everything else
+# BlueZ publishes is dropped on arrival.
+ADAPTER_PROPERTIES = {"Address": "s", "Alias": "s", "Name": "s", "Powered": "b"}
+DEVICE_PROPERTIES = {"Adapter": "o", "Address": "s", "Alias": "s", "Connected": "b", "Paired": "b"}
+
+def filter_properties(properties, wanted):
+    return {name: value for (name, value) in properties.items() if name in wanted}
+
+def pack_properties(properties, wanted):
+    return {name: GLib.Variant(wanted[name], value) for (name, value) in properties.items() if name in wanted}
+
+# Keeps a copy of the BlueZ adapters and devices, either straight from the
+# org.bluez ObjectManager on the system bus or, with use_broker, from the
+# snapshot published by blueberry-broker on the session bus.
+class Mirror(GObject.GObject):
+    __gsignals__ = {
+        'ready': (GObject.SignalFlags.RUN_LAST, None, ()),
+        'adapter-changed': (GObject.SignalFlags.RUN_LAST, None, (str,)),
+        'adapter-removed': (GObject.SignalFlags.RUN_LAST, None, (str,)),
+        'device-changed': (GObject.SignalFlags.RUN_LAST, None, (str,)),
+        'device-removed': (GObject.SignalFlags.RUN_LAST, None, (str,)),
+    }
+
+    def __init__(self, use_broker=False, debug=False):
+        GObject.GObject.__init__(self)
+        self.enable_debugging = debug
+        self.adapters = {}
+        self.devices = {}
+        self.ready = False
+
+        self.connection = None
+        self.subscriptions = []
+        self.watch_id = 0
+        self.stopped = False
+        self.system_bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+
+        if use_broker:
+            self.connect_to_broker()
+        else:
+            self.connect_to_bluez()
+
+    def get_default_adapter(self):
+        # BlueZ has no notion of a default adapter: prefer a powered one,
+        # then the lowest hciN.
+        if not self.adapters:
+            return None
+        paths = sorted(self.adapters, key=lambda path: (not self.adapters[path].get("Powered", False), path))
+        return paths[0]
+
+    def get_adapter_alias(self, path=None):
+        if path is None:
+            path = self.get_default_adapter()
+        adapter = self.adapters.get(path)
+        if adapter is None:
+            return None
+        return adapter.get("Alias", adapter.get("Name"))
+
+    def set_adapter_alias(self, path, alias, callback=None):
+        # callback(error) is called once BlueZ has replied, with None on success
+        def on_reply(connection, result):
+            try:
+                connection.call_finish(result)
+                error = None
+            except GLib.Error as e:
+                error = e.message
+            if callback is not None:
+                callback(error)
+
+        self.system_bus.call(BLUEZ_BUS_NAME, path, PROPERTIES_INTERFACE, "Set",
+                             GLib.Variant("(ssv)", (ADAPTER_INTERFACE, "Alias", GLib.Variant("s", alias))),
+                             None, Gio.DBusCallFlags.NONE, -1, None, on_reply)
+
+    def connect_device(self, path, connect, callback=None):
+        # callback(error) is called once BlueZ has replied, with None on success
+        def on_reply(connection, result):
+            try:
+                connection.call_finish(result)
+                error = None
+            except GLib.Error as e:
+                error = e.message
+                self.debug("%s %s failed: %s" % (method, path, error))
+            if callback is not None:
+                callback(error)
+
+        method = "Connect" if connect else "Disconnect"
+        self.system_bus.call(BLUEZ_BUS_NAME, path, DEVICE_INTERFACE, method,
+                             None, None, Gio.DBusCallFlags.NONE, -1, None, on_reply)
+
+    def get_devices(self, adapter_path):
+        return {path: device for (path, device) in self.devices.items() if device.get("Adapter") == adapter_path}
+
+    def stop(self):
+        self.stopped = True
+        for sub_id in self.subscriptions:
+            self.connection.signal_unsubscribe(sub_id)
+        self.subscriptions = []
+        if self.watch_id:
+            Gio.bus_unwatch_name(self.watch_id)
+            self.watch_id = 0
+
+    # BlueZ
+
+    def connect_to_bluez(self):
+        self.connection = self.system_bus
+        self.watch_id = Gio.bus_watch_name_on_connection(self.connection, BLUEZ_BUS_NAME, Gio.BusNameWatcherFlags.NONE,
+                                                         self.on_bluez_appeared, self.on_bluez_vanished)
+
+        self.subscribe(BLUEZ_BUS_NAME, OBJECT_MANAGER_INTERFACE, "InterfacesAdded", None, self.on_interfaces_added)
+        self.subscribe(BLUEZ_BUS_NAME, OBJECT_MANAGER_INTERFACE, "InterfacesRemoved", None, self.on_interfaces_removed)
+        self.subscribe(BLUEZ_BUS_NAME, PROPERTIES_INTERFACE, "PropertiesChanged", ADAPTER_INTERFACE, self.on_properties_changed)
+        self.subscribe(BLUEZ_BUS_NAME, PROPERTIES_INTERFACE, "PropertiesChanged", DEVICE_INTERFACE, self.on_properties_changed)
+
+    def subscribe(self, sender, interface, member, arg0, callback):
+        sub_id = self.connection.signal_subscribe(sender, interface, member, None, arg0, Gio.DBusSignalFlags.NONE, callback)
+        self.subscriptions.append(sub_id)
+
+    def on_bluez_appeared(self, connection, name, owner):
+        if self.stopped:
+            return
+        self.connection.call(BLUEZ_BUS_NAME, "/", OBJECT_MANAGER_INTERFACE, "GetManagedObjects",
+                             None, GLib.VariantType.new("(a{oa{sa{sv}}})"), Gio.DBusCallFlags.NONE, -1, None,
+                             self.on_managed_objects)
+
+    def on_managed_objects(self, connection, result):
+        if self.stopped:
+            return
+        try:
+            (objects,) = connection.call_finish(result).unpack()
+        except GLib.Error as e:
+            self.debug("GetManagedObjects failed: %s" % e.message)
+            return
+
+        for (path, interfaces) in objects.items():
+            self.add_interfaces(path, interfaces)
+
+        self.set_ready()
+
+    def on_bluez_vanished(self, connection, name):
+        if self.stopped:
+            return
+        for path in list(self.devices):
+            self.remove_device(path)
+        for path in list(self.adapters):
+            self.remove_adapter(path)
+
+    def on_interfaces_added(self, connection, sender, path, interface, signal, params):
+        (object_path, interfaces) = params.unpack()
+        self.add_interfaces(object_path, interfaces)
+
+    def on_interfaces_removed(self, connection, sender, path, interface, signal, params):
+        (object_path, interfaces) = params.unpack()
+        if DEVICE_INTERFACE in interfaces:
+            self.remove_device(object_path)
+        if ADAPTER_INTERFACE in interfaces:
+            self.remove_adapter(object_path)
+
+    def on_properties_changed(self, connection, sender, path, interface, signal, params):
+        (changed_interface, changed, invalidated) = params.unpack()
+        if changed_interface == ADAPTER_INTERFACE:
+            self.update_adapter(path, changed)
+        elif changed_interface == DEVICE_INTERFACE:
+            self.update_device(path, changed)
+
+    def add_interfaces(self, path, interfaces):
+        if ADAPTER_INTERFACE in interfaces:
+            self.update_adapter(path, interfaces[ADAPTER_INTERFACE])
+        if DEVICE_INTERFACE in interfaces:
+            self.update_device(path, interfaces[DEVICE_INTERFACE])
+
+    # Broker
+
+    def connect_to_broker(self):
+        self.connection = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+
+        self.subscribe(BROKER_BUS_NAME, BROKER_INTERFACE, "AdapterChanged", None, self.on_broker_signal)
+        self.subscribe(BROKER_BUS_NAME, BROKER_INTERFACE, "AdapterRemoved", None, self.on_broker_signal)
+        self.subscribe(BROKER_BUS_NAME, BROKER_INTERFACE, "DeviceChanged", None, self.on_broker_signal)
+        self.subscribe(BROKER_BUS_NAME, BROKER_INTERFACE, "DeviceRemoved", None, self.on_broker_signal)
+
+        self.connection.call(BROKER_BUS_NAME, BROKER_OBJECT_PATH, BROKER_INTERFACE, "GetBluezState",
+                             None, GLib.VariantType.new("(a{oa{sv}}a{oa{sv}})"), Gio.DBusCallFlags.NONE, BROKER_TIMEOUT, None,
+                             self.on_broker_state)
+
+    def on_broker_state(self, connection, result):
+        if self.stopped:
+            return
+        try:
+            (adapters, devices) = connection.call_finish(result).unpack()
+        except GLib.Error as e:
+            self.debug("Could not reach %s, using BlueZ directly: %s" % (BROKER_BUS_NAME, e.message))
+            for sub_id in self.subscriptions:
+                self.connection.signal_unsubscribe(sub_id)
+            self.subscriptions = []
+            self.connect_to_bluez()
+            return
+
+        for (path, properties) in adapters.items():
+            self.update_adapter(path, properties)
+        for (path, properties) in devices.items():
+            self.update_device(path, properties)
+
+        self.set_ready()
+
+    def on_broker_signal(self, connection, sender, path, interface, signal, params):
+        if signal == "AdapterChanged":
+            self.update_adapter(*params.unpack())
+        elif signal == "AdapterRemoved":
+            self.remove_adapter(*params.unpack())
+        elif signal == "DeviceChanged":
+            self.update_device(*params.unpack())
+        elif signal == "DeviceRemoved":
+            self.remove_device(*params.unpack())
+
+    # Table updates
+
+    def set_ready(self):
+        if not self.ready:
+            self.ready = True
+            self.emit("ready")
+
+    def update_adapter(self, path, properties):
+        properties = filter_properties(properties, ADAPTER_PROPERTIES)
+        adapter = self.adapters.get(path)
+        if adapter is None:
+            adapter = self.adapters[path] = {}
+        elif properties.items() <= adapter.items():
+            return
+        adapter.update(properties)
+        self.debug("adapter %s: %s" % (path, properties))
+        self.emit("adapter-changed", path)
+
+    def remove_adapter(self, path):
+        if self.adapters.pop(path, None) is not None:
+            self.emit("adapter-removed", path)
+
+    def update_device(self, path, properties):
+        properties = filter_properties(properties, DEVICE_PROPERTIES)
+        device = self.devices.get(path)
+        if device is None:
+            device = self.devices[path] = {}
+        elif properties.items() <= device.items():
+            return
+        device.update(properties)
+        self.debug("device %s: %s" % (path, properties))
+        self.emit("device-changed", path)
+
+    def remove_device(self, path):
+        if self.devices.pop(path, None) is not None:
+            self.emit("device-removed", path)
+
+    def debug(self, msg):
+        if self.enable_debugging:
+            print(msg)
@@ -1,8 +1,13 @@
 
 import _thread as thread
+import collections
+import os
 import subprocess
 import re
-from gi.repository import GLib
+import struct
+import threading
+import time
+from gi.repository import GLib, Gio
 
 RFKILL_CHK = ["/usr/sbin/rfkill", "list", "bluetooth"]
 RFKILL_BLOCK = ["/usr/sbin/rfkill", "block", "bluetooth"]
@@ -10,35 +15,154 @@ RFKILL_UNBLOCK = ["/usr/sbin/rfkill", "unblock", "bluetooth"]
 
 RFKILL_EVENT_MONITOR = ["/usr/lib/blueberry/safechild", "/usr/sbin/rfkill", "event"]
 
+RFKILL_DEVICE = "/dev/rfkill"
+
+# struct rfkill_event from <linux/rfkill.h>: __u32 idx; __u8 type, op, soft, hard.
+# Newer kernels append extra fields, so only the leading 8 bytes are decoded.
+RFKILL_EVENT = struct.Struct("=IBBBB")
+
+RFKILL_TYPE_BLUETOOTH = 2
+
+RFKILL_OP_ADD = 0
+RFKILL_OP_DEL = 1
+RFKILL_OP_CHANGE = 2
+RFKILL_OP_CHANGE_ALL = 3
+
+RFKILL_SYSFS = "/sys/class/rfkill"
+
+# blueberry-broker owns the session's single rfkill monitor and BlueZ mirror
+BROKER_BUS_NAME = "org.linuxmint.blueberry.Broker"
+BROKER_OBJECT_PATH = "/org/linuxmint/blueberry/Broker"
+BROKER_INTERFACE = "org.linuxmint.blueberry.Broker"
+BROKER_TIMEOUT = 5000
+
+RFKILL_TYPES = {"all": 0, "wlan": 1, "bluetooth": 2, "uwb": 3, "wimax": 4, "wwan": 5, "gps": 6, "fm": 7, "nfc": 8}
+
+class RfkillDevice:
+    __slots__ = ("idx", "type", "soft", "hard", "name")
+
+    def __init__(self, idx, type, soft, hard, name=None):
+        self.idx = idx
+        self.type = type
+        self.soft = soft
+        self.hard = hard
+        self.name = name
+
+    def __repr__(self):
+        return "RfkillDevice(idx=%d, type=%d, soft=%d, hard=%d, name=%r)" % (self.idx, self.type, self.soft, self.hard, self.name)
+
+# 'rfkill event' prints one line per event, see Interface.update_state()
+EVENT_LINE_RE = re.compile(r'idx (?P<idx>\d+) type (?P<type>\d+) op (?P<op>\d+) soft (?P<soft>\d+) hard (?P<hard>\d+)')
+
+def parse_event_line_regex(line):
+    match = EVENT_LINE_RE.search(line)
+    if match is None:
+        return None
+
+    return (int(match.group('idx')),
+            int(match.group('type')),
+            int(match.group('op')),
+            int(match.group('soft')),
+            int(match.group('hard')))
+
+# Same result as parse_event_line_regex(), without the regex engine
+def parse_event_line(line):
+    fields = line.split()
+    try:
+        start = fields.index("idx")
+        (_, idx, type_key, type, op_key, op, soft_key, soft, hard_key, hard) = fields[start:start + 10]
+        if (type_key, op_key, soft_key, hard_key) != ("type", "op", "soft", "hard"):
+            return None
+        return (int(idx), int(type), int(op), int(soft), int(hard))
+    except ValueError:
+        return None
+
+def read_sysfs_attribute(idx, attribute):
+    try:
+        with open(os.path.join(RFKILL_SYSFS, "rfkill%d" % idx, attribute)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
 class Interface:
-    def __init__(self, output_callback, debug):
+    def __init__(self, output_callback, debug, min_interval=0, backend=None):
         self.enable_debugging = debug
         self.output_callback = output_callback
-        self.have_adapter = False
-        self.adapter_index = -1
+        self.backend = backend if backend is not None else DeviceBackend()
+
+        # UI updates are coalesced into a single pending source, dispatched
+        # at most once every min_interval milliseconds.
+        self.min_interval = min_interval
+        self.ui_lock = threading.Lock()
+        self.ui_pending = False
+        self.ui_last_dispatch = 0
+        self.events_received = 0
+        self.callbacks_dispatched = 0
+
+        # All rfkill devices by index, built once and then kept up to date
+        # from the event stream. Bluetooth adapters are also kept in their
+        # own table.
+        self.devices = {}
+        self.adapters = {}
+        self.adapter_callbacks = []
+        self.error_callbacks = []
 
-        self.tproc = None
         self.blockproc = None
 
-        self.hard_block = False
-        self.soft_block = False
-        self.rfkill_err = None
+        # Toggle engine: at most one request in flight, plus the most recent
+        # request that arrived while it was running.
+        self.rfkill_write_fd = None
+        self.rfkill_write_failed = False
+        self.toggle_request = None
+        self.toggle_pending = None
+        self.toggle_latencies = collections.deque(maxlen=32)
 
-        self.monitor_killer = False
+        self.rfkill_err = None
 
         self.adapter_check()
         self.start_event_monitor()
 
     def adapter_check(self):
-        proc = subprocess.run(RFKILL_CHK, stdout=subprocess.PIPE)
-        if proc.returncode != 0:
+        self.devices = self.backend.scan(self)
+
+        self.adapters = {idx: device for (idx, device) in self.devices.items() if device.type == RFKILL_TYPE_BLUETOOTH}
+
+        self.debug("adapter_check devices: %s" % list(self.devices.values()))
+        return self.have_adapter
+
+    def scan_sysfs(self):
+        devices = {}
+
+        for entry in os.listdir(RFKILL_SYSFS):
+            if not entry.startswith("rfkill"):
+                continue
+            try:
+                idx = int(entry[6:])
+                device = RfkillDevice(idx,
+                                      RFKILL_TYPES.get(read_sysfs_attribute(idx, "type"), -1),
+                                      int(read_sysfs_attribute(idx, "soft")),
+                                      int(read_sysfs_attribute(idx, "hard")),
+                                      read_sysfs_attribute(idx, "name"))
+            except (TypeError, ValueError):
+                # The device went away while we were reading it
+                continue
+            devices[idx] = device
+
+        return devices
+
+    def scan_rfkill_list(self):
+        try:
+            proc = subprocess.run(RFKILL_CHK, stdout=subprocess.PIPE)
+        except OSError:
+            proc = None
+
+        if proc is None or proc.returncode != 0:
             self.debug("Error running command: %s." % RFKILL_CHK)
             res = ""
         else:
             res = proc.stdout.decode('utf-8')
 
-        match = None
-        have_adapter = False
+        devices = {}
 
         '''
         Assume the output of:
@@ -51,29 +175,79 @@ class Interface:
             Soft blocked: yes
             Hard blocked: no
         '''
-        if res:
-            match = re.search(r'^(?P<idx>\d+): .+: Bluetooth\n', res)
-
-        if match:
-            self.debug("adapter_check full output:\n%s" % res)
-            self.adapter_index = int(match.group('idx'))
-            self.debug("adapter_check found adapter at %d" % self.adapter_index)
-            have_adapter = True
+        for match in re.finditer(r'^(?P<idx>\d+): (?P<name>.+): Bluetooth\n\s+Soft blocked: (?P<soft>yes|no)\n\s+Hard blocked: (?P<hard>yes|no)', res, re.MULTILINE):
+            idx = int(match.group('idx'))
+            devices[idx] = RfkillDevice(idx,
+                                        RFKILL_TYPE_BLUETOOTH,
+                                        int(match.group('soft') == "yes"),
+                                        int(match.group('hard') == "yes"),
+                                        match.group('name'))
+
+        return devices
+
+    @property
+    def have_adapter(self):
+        return len(self.adapters) > 0
+
+    @property
+    def adapter_index(self):
+        return min(self.adapters) if self.adapters else -1
+
+    # Bluetooth counts as on as long as one adapter is neither soft nor hard
+    # blocked. When none is usable, it is hard blocked only if every adapter
+    # is, since otherwise unblocking would bring at least one of them up.
+    @property
+    def hard_block(self):
+        return self.have_adapter and all(adapter.hard for adapter in self.adapters.values())
+
+    @property
+    def soft_block(self):
+        if self.hard_block:
+            return any(adapter.soft for adapter in self.adapters.values())
+        return self.have_adapter and all(adapter.soft or adapter.hard for adapter in self.adapters.values())
+
+    def add_adapter_callback(self, callback):
+        # callback(op, device) is called for every change to a Bluetooth adapter
+        self.adapter_callbacks.append(callback)
+
+    def add_error_callback(self, callback):
+        # callback(error) is called for every failed block request, even
+        # when it fails the same way as the previous one
+        self.error_callbacks.append(callback)
+
+    def update_index(self, idx, type, op, soft, hard):
+        if op == RFKILL_OP_DEL:
+            device = self.devices.pop(idx, None)
+            self.adapters.pop(idx, None)
         else:
-            self.debug("adapter_check no output (no adapter)")
-
-        self.have_adapter = have_adapter
-        return have_adapter
+            device = self.devices.get(idx)
+            if device is None:
+                device = RfkillDevice(idx, type, soft, hard, read_sysfs_attribute(idx, "name"))
+                self.devices[idx] = device
+                if type == RFKILL_TYPE_BLUETOOTH:
+                    self.adapters[idx] = device
+            else:
+                device.soft = soft
+                device.hard = hard
+
+        if device is not None and device.type == RFKILL_TYPE_BLUETOOTH:
+            self.debug("adapter %d: op %d soft %d hard %d" % (idx, op, soft, hard))
+            for callback in self.adapter_callbacks:
+                callback(op, device)
 
     def start_event_monitor(self):
-        if not self.tproc and not self.monitor_killer:
-            thread.start_new_thread(self.event_monitor_thread, (None,))
-
-    def event_monitor_thread(self, data):
-        self.tproc = subprocess.Popen(RFKILL_EVENT_MONITOR, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-        while self.tproc.poll() is None and not self.monitor_killer:
-            l = self.tproc.stdout.readline().decode('utf-8') # This blocks until it receives a newline.
-            self.update_state(l)
+        # Read events straight from the kernel when we can, and only fall
+        # back to parsing the output of 'rfkill event' when we can't.
+        if not self.backend.start(self):
+            self.fall_back()
+
+    def fall_back(self):
+        self.backend.stop()
+        self.backend = self.backend.fallback()
+        self.debug("Falling back to %s" % self.backend.__class__.__name__)
+        self.adapter_check()
+        self.start_event_monitor()
+        self.update_ui()
 
     def update_state(self, line):
         self.debug("update_state line: %s" % line)
@@ -95,56 +269,390 @@ class Interface:
         2017-12-08 11:54:16,972431-0800: idx 1 type 1 op 0 soft 0 hard 0
         2017-12-08 11:54:16,972474-0800: idx 4 type 2 op 0 soft 0 hard 0
         '''
-        if not self.have_adapter:
-            self.adapter_check()
-
-        if self.have_adapter:
-            match = re.search(r'idx (?P<idx>\d+) type (?P<type>\d+) op (?P<op>\d+) soft (?P<soft>\d+) hard (?P<hard>\d+)', line)
-            if match:
-                if int(match.group('idx')) == self.adapter_index:
-                    if int(match.group('op')) == 1:
-                        self.adapter_check()
-                    self.soft_block = int(match.group('soft')) == 1
-                    self.hard_block = int(match.group('hard')) == 1
+        event = parse_event_line(line)
+        if event:
+            self.handle_event(*event)
+        else:
+            self.handle_event(None, None, None, None, None)
+
+    def handle_event(self, idx, type, op, soft, hard):
+        self.events_received += 1
+
+        if idx is not None:
+            self.update_index(idx, type, op, soft, hard)
+
+        if self.toggle_request is not None and type == RFKILL_TYPE_BLUETOOTH and op != RFKILL_OP_DEL:
+            (blocked, started) = self.toggle_request
+            if (soft == 1) == blocked:
+                latency = time.monotonic() - started
+                self.toggle_latencies.append(latency)
+                self.toggle_request = None
+                self.debug("toggle to blocked=%s confirmed after %.1f ms" % (blocked, latency * 1000))
 
         self.update_ui()
 
     def update_ui(self):
-        GLib.idle_add(self.output_callback)
+        with self.ui_lock:
+            if self.ui_pending:
+                return
+            self.ui_pending = True
+
+        delay = 0
+        if self.min_interval > 0:
+            elapsed = (time.monotonic() - self.ui_last_dispatch) * 1000
+            delay = max(0, int(self.min_interval - elapsed))
+
+        if delay > 0:
+            GLib.timeout_add(delay, self.dispatch_ui)
+        else:
+            GLib.idle_add(self.dispatch_ui)
+
+    def dispatch_ui(self):
+        with self.ui_lock:
+            self.ui_pending = False
+
+        self.ui_last_dispatch = time.monotonic()
+        self.callbacks_dispatched += 1
+        self.debug("dispatch_ui: %d events, %d callbacks" % (self.events_received, self.callbacks_dispatched))
+        self.output_callback()
+        return GLib.SOURCE_REMOVE
 
     def try_set_blocked(self, blocked):
-        thread.start_new_thread(self.set_block_thread, (blocked,))
+        if self.blockproc:
+            # Newer requests replace whatever is still waiting behind the running one
+            self.debug("try_set_blocked queueing blocked=%s" % blocked)
+            self.toggle_pending = blocked
+            return
 
-    def set_block_thread(self, data):
-        block = data
+        self.toggle_request = (blocked, time.monotonic())
 
-        if block:
-            self.debug("set_block_thread blocking")
-            self.blockproc = subprocess.Popen(RFKILL_BLOCK, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if self.backend.set_blocked(blocked) or self.write_block_event(blocked):
+            self.rfkill_err = None
         else:
-            self.debug("set_block_thread unblocking")
-            self.blockproc = subprocess.Popen(RFKILL_UNBLOCK, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.spawn_block_process(blocked)
+
+    def write_block_event(self, blocked):
+        if self.rfkill_write_failed:
+            return False
+
+        try:
+            if self.rfkill_write_fd is None:
+                self.rfkill_write_fd = os.open(RFKILL_DEVICE, os.O_WRONLY | os.O_CLOEXEC)
+            event = RFKILL_EVENT.pack(0, RFKILL_TYPE_BLUETOOTH, RFKILL_OP_CHANGE_ALL, 1 if blocked else 0, 0)
+            os.write(self.rfkill_write_fd, event)
+        except OSError as e:
+            self.debug("Could not write to %s, using rfkill instead: %s" % (RFKILL_DEVICE, e))
+            self.rfkill_write_failed = True
+            self.close_rfkill_write_device()
+            return False
+
+        self.debug("write_block_event blocked=%s" % blocked)
+        return True
+
+    def close_rfkill_write_device(self):
+        if self.rfkill_write_fd is not None:
+            os.close(self.rfkill_write_fd)
+            self.rfkill_write_fd = None
+
+    def spawn_block_process(self, blocked):
+        argv = RFKILL_BLOCK if blocked else RFKILL_UNBLOCK
+        self.debug("spawn_block_process %s" % " ".join(argv))
+
+        try:
+            self.blockproc = Gio.Subprocess.new(argv, Gio.SubprocessFlags.STDOUT_SILENCE | Gio.SubprocessFlags.STDERR_PIPE)
+        except GLib.Error as e:
+            self.on_block_error(e.message)
+            return
+
+        self.blockproc.communicate_utf8_async(None, None, self.on_block_process_finished)
+
+    def on_block_process_finished(self, proc, result):
+        try:
+            _, _, err = proc.communicate_utf8_finish(result)
+        except GLib.Error as e:
+            err = e.message
+
+        self.blockproc = None
 
-        # Check for errors and continue
-        _,err = self.blockproc.communicate()
         if err:
-            error = err.decode("utf-8")
-            self.debug(error)
-            self.rfkill_err = error
-            # Force UI update
-            self.update_ui()
+            self.on_block_error(err)
         else:
             self.rfkill_err = None
 
-        self.blockproc = None
-        self.debug("set_block_thread finished")
-        thread.exit()
+        self.debug("spawn_block_process finished")
+
+        if self.toggle_pending is not None:
+            blocked = self.toggle_pending
+            self.toggle_pending = None
+            self.try_set_blocked(blocked)
+
+    def on_block_error(self, error):
+        self.debug(error)
+        self.rfkill_err = error
+        self.toggle_request = None
+        for callback in self.error_callbacks:
+            callback(error)
+        # Force UI update
+        self.update_ui()
 
     def terminate(self):
+        self.backend.stop()
+        self.close_rfkill_write_device()
+
+        self.toggle_pending = None
         if self.blockproc:
-            self.blockproc.kill()
+            self.blockproc.force_exit()
 
     def debug(self, msg):
         if self.enable_debugging:
             print(msg)
 
+
+# Event sources for Interface. A backend provides the initial device table
+# and then feeds events through Interface.handle_event() or update_state().
+class Backend:
+    def scan(self, interface):
+        if os.path.isdir(RFKILL_SYSFS):
+            return interface.scan_sysfs()
+        return interface.scan_rfkill_list()
+
+    def start(self, interface):
+        return False
+
+    # Return True when the backend took care of the request itself
+    def set_blocked(self, blocked):
+        return False
+
+    def stop(self):
+        pass
+
+    # The backend to use once this one stops working
+    def fallback(self):
+        return ProcessBackend()
+
+class DeviceBackend(Backend):
+    def __init__(self):
+        self.interface = None
+        self.fd = None
+        self.watch = None
+
+    def start(self, interface):
+        self.interface = interface
+
+        try:
+            self.fd = os.open(RFKILL_DEVICE, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError as e:
+            interface.debug("Could not open %s, using rfkill event instead: %s" % (RFKILL_DEVICE, e))
+            return False
+
+        self.watch = GLib.io_add_watch(self.fd,
+                                       GLib.PRIORITY_DEFAULT,
+                                       GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+                                       self.on_event)
+        interface.debug("Monitoring rfkill events from %s" % RFKILL_DEVICE)
+        return True
+
+    def stop(self):
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def on_event(self, fd, condition):
+        if condition & (GLib.IOCondition.HUP | GLib.IOCondition.ERR):
+            self.interface.debug("%s was closed, using rfkill event instead" % RFKILL_DEVICE)
+            self.watch = None
+            self.interface.fall_back()
+            return False
+
+        # The kernel hands out exactly one event per read(), so drain
+        # everything that is queued before returning to the main loop.
+        while True:
+            try:
+                data = os.read(fd, 64)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self.interface.debug("Error reading %s, using rfkill event instead: %s" % (RFKILL_DEVICE, e))
+                self.watch = None
+                self.interface.fall_back()
+                return False
+
+            if len(data) < RFKILL_EVENT.size:
+                break
+
+            idx, type, op, soft, hard = RFKILL_EVENT.unpack_from(data)
+            self.interface.debug("rfkill event: idx %d type %d op %d soft %d hard %d" % (idx, type, op, soft, hard))
+            self.interface.handle_event(idx, type, op, soft, hard)
+
+        return True
+
+# Follows the rfkill state published by blueberry-broker, so that the
+# blueberry window and tray share a single monitor.
+class BrokerBackend(Backend):
+    def __init__(self):
+        self.interface = None
+        self.proxy = None
+        self.handler_ids = []
+
+    def scan(self, interface):
+        try:
+            self.proxy = Gio.DBusProxy.new_for_bus_sync(Gio.BusType.SESSION,
+                                                        Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES,
+                                                        None,
+                                                        BROKER_BUS_NAME,
+                                                        BROKER_OBJECT_PATH,
+                                                        BROKER_INTERFACE,
+                                                        None)
+            (devices,) = self.proxy.call_sync("GetRfkillDevices", None, Gio.DBusCallFlags.NONE, BROKER_TIMEOUT, None).unpack()
+        except GLib.Error as e:
+            interface.debug("Could not reach %s: %s" % (BROKER_BUS_NAME, e.message))
+            self.proxy = None
+            return Backend.scan(self, interface)
+
+        return {idx: RfkillDevice(idx, type, soft, hard, name) for (idx, type, soft, hard, name) in devices}
+
+    def start(self, interface):
+        if self.proxy is None:
+            return False
+
+        self.interface = interface
+        self.handler_ids.append(self.proxy.connect("g-signal", self.on_signal))
+        self.handler_ids.append(self.proxy.connect("notify::g-name-owner", self.on_name_owner_changed))
+        interface.debug("Following rfkill events from %s" % BROKER_BUS_NAME)
+        return True
+
+    def stop(self):
+        if self.proxy is not None:
+            for handler_id in self.handler_ids:
+                self.proxy.disconnect(handler_id)
+            self.handler_ids = []
+            self.proxy = None
+
+    def fallback(self):
+        return DeviceBackend()
+
+    def set_blocked(self, blocked):
+        if self.proxy is None:
+            return False
+
+        self.proxy.call("SetBlocked", GLib.Variant("(b)", (blocked,)), Gio.DBusCallFlags.NONE, BROKER_TIMEOUT, None, None)
+        return True
+
+    def on_signal(self, proxy, sender, signal, params):
+        if signal == "RfkillEvent":
+            self.interface.handle_event(*params.unpack())
+        elif signal == "RfkillError":
+            (error,) = params.unpack()
+            self.interface.rfkill_err = error if error else None
+            self.interface.update_ui()
+
+    def on_name_owner_changed(self, proxy, pspec):
+        if proxy.get_name_owner() is None:
+            self.interface.debug("%s went away" % BROKER_BUS_NAME)
+            self.interface.fall_back()
+
+class ProcessBackend(Backend):
+    def __init__(self):
+        self.interface = None
+        self.tproc = None
+        self.stopped = False
+
+    def start(self, interface):
+        self.interface = interface
+        thread.start_new_thread(self.event_monitor_thread, (None,))
+        return True
+
+    def stop(self):
+        self.stopped = True
+        if self.tproc:
+            self.close_monitor()
+
+    def close_monitor(self):
+        # safechild kills 'rfkill event' once its stdin is closed, killing
+        # safechild itself would leave rfkill running
+        self.tproc.stdin.close()
+        try:
+            self.tproc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.tproc.terminate()
+
+    def event_monitor_thread(self, data):
+        self.tproc = subprocess.Popen(RFKILL_EVENT_MONITOR, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+        if self.stopped:
+            # stop() ran before the monitor was started
+            self.close_monitor()
+            return
+        while self.tproc.poll() is None and not self.stopped:
+            l = self.tproc.stdout.readline().decode('utf-8') # This blocks until it receives a newline.
+            # Events are handled on the main loop, like with the other backends
+            GLib.idle_add(self.interface.update_state, l)
+
+# Replays recorded 'rfkill event' output from a file or a pipe, so Interface
+# can be exercised without hardware. Block requests are answered with a
+# change event for every adapter, like the kernel would.
+class ScriptedBackend(Backend):
+    def __init__(self, path, finished_callback=None):
+        self.path = path
+        self.finished_callback = finished_callback
+        self.interface = None
+        self.fd = None
+        self.watch = None
+        self.buffer = b""
+        self.lines_read = 0
+
+    def scan(self, interface):
+        return {}
+
+    def start(self, interface):
+        self.interface = interface
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        self.watch = GLib.io_add_watch(self.fd,
+                                       GLib.PRIORITY_DEFAULT,
+                                       GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+                                       self.on_readable)
+        return True
+
+    def stop(self):
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def set_blocked(self, blocked):
+        for adapter in list(self.interface.adapters.values()):
+            self.interface.handle_event(adapter.idx, adapter.type, RFKILL_OP_CHANGE, 1 if blocked else 0, adapter.hard)
+        return True
+
+    def on_readable(self, fd, condition):
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            data = b""
+
+        if data:
+            lines = (self.buffer + data).split(b"\n")
+            self.buffer = lines.pop()
+            for line in lines:
+                self.lines_read += 1
+                self.interface.update_state(line.decode("utf-8"))
+            return True
+
+        if self.buffer:
+            self.lines_read += 1
+            self.interface.update_state(self.buffer.decode("utf-8"))
+            self.buffer = b""
+
+        self.watch = None
+        self.stop()
+
+        if self.finished_callback:
+            self.finished_callback()
+
+        return False